@@ -25,6 +25,14 @@ the V4L2 interface and records their outputs.
 from casysControl import CasysControl
 from casys_const import *
 from casysGui import CasysGui
+from casysStorage import CasysStoragePool
+from casysRecovery import CasysSegmentRecovery
+from casysConfig import CasysConfig
+from casysServer import CasysControlServer
+from casysSupervisor import CasysSupervisor
+from casysScheduler import CasysAlignedTimer, CasysScheduler
+from casysReplication import CasysReplicator
+import casysProfiler
 
 import os
 import argparse
@@ -33,7 +41,6 @@ from glob import iglob
 from queue import Queue
 from time import strftime, localtime, time, sleep
 from io import IOBase
-from tempfile import TemporaryFile
 
 import logging
 from logging.handlers import RotatingFileHandler, SMTPHandler, QueueHandler, QueueListener
@@ -59,6 +66,9 @@ It parses the arguments and initialized the logger.
     grp_log.add_argument('--logformat', nargs=1, help='set the logger format', metavar='fmt')
     grp_log.add_argument('--logfile', nargs=1, help='specify the log file', metavar='file')
 
+    grp_set = parser.add_argument_group( 'Settings arguments' );
+    grp_set.add_argument('--settings', default=SETTINGS_FILE, help='specify the settings file', metavar='file')
+
     grp_inf = parser.add_argument_group( 'Informational arguments' );
     grp_inf.add_argument('-h', '--help', action='help', help='show this help message and exit')
     grp_inf.add_argument('-v', '--version', action='version', version='%(prog)s {0}'.format(VERSION))
@@ -115,22 +125,64 @@ It parses the arguments and initialized the logger.
 
     casys_log.info("Basic initialization.")
 
-    casys_log.debug("Checking the videos' directory.")
+    casys_log.debug("Reading the settings.")
+    config = CasysConfig(args.settings)
+
+    if config['profiler']['enabled']:
+        casys_log.debug("Installing the main-loop profiler.")
+        profiler = casysProfiler.install(config['profiler']['threshold'], config['profiler']['tracers'])
+        if config['profiler']['dump_interval']:
+            GLib.timeout_add_seconds(config['profiler']['dump_interval'], profiler.dump,
+                                     config['profiler']['dump_file'])
+
+    casys_log.debug("Checking the videos' volumes.")
+    storage = CasysStoragePool(config['storage']['paths'])
     try:
-        CheckVideoDirectory()
+        storage.check()
     except:
-        casys_log.critical("An exception was raised while setting videos' directory", exc_info=True)
-
-    casys_log.debug("Creating the CasysControl object.")
-    casys = CasysControl()
+        casys_log.critical("An exception was raised while setting videos' volumes", exc_info=True)
+
+    casys_log.debug("Recovering segments left incomplete.")
+    CasysSegmentRecovery().scan(storage, config['storage']['extension'])
+
+    replicator = CasysReplicator(config['replication'],
+                                 lambda: storage.segments(config['storage']['extension']))
+    if config['replication']['enabled']:
+        casys_log.debug("Starting the replication.")
+        try:
+            replicator.start()
+        except Exception:
+            casys_log.critical("Failed to start the replication", exc_info=True)
+    storage.connect(replicator.enqueue)
+
+    if config['supervisor']['enabled']:
+        casys_log.debug("Creating the CasysSupervisor object (multi-process mode).")
+        casys = CasysSupervisor(storage, config)
+    else:
+        casys_log.debug("Creating the CasysControl object.")
+        casys = CasysControl(storage, config)
     casys_log.debug("Starting to record.")
     casys.record()
 
     #Setting timer:
-    #TODO: Goto beginning of the hour first?
-    casys_log.debug("Adding cleanup and fragmentation timers.")
-    GLib.timeout_add_seconds(5, cleaner, casys)
-    GLib.timeout_add_seconds(FRAGMENT_TIME, casys.Fragment)
+    casys_log.debug("Adding cleanup, storage and fragmentation timers.")
+    GLib.timeout_add_seconds(5, cleaner, storage, config, replicator)
+    GLib.timeout_add_seconds(STORAGE_REFRESH_TIME, storage.refresh)
+    timers = {'fragment_time': config['storage']['fragment_time']}
+    # Segments start on the wall-clock boundaries (e.g. on the hour).
+    timers['fragment'] = CasysAlignedTimer(timers['fragment_time'], casys.Fragment)
+
+    casys_log.debug("Starting the scheduler.")
+    scheduler = CasysScheduler(casys, config)
+    scheduler.start()
+
+    casys_log.debug("Watching the settings for changes.")
+    config.connect(lambda config, changes: reconfigure(config, changes, casys, storage, replicator, timers))
+    config.watch()
+
+    casys_log.debug("Starting the control server.")
+    server = CasysControlServer(casys, storage, config['control'], replicator, config['storage']['extension'])
+    server.start()
 
     #Initialize and show Gui.
     casys_log.debug("Initializing the casys gui.")
@@ -158,17 +210,48 @@ It parses the arguments and initialized the logger.
     # del casys
 
 
-def cleaner(casys):
+def reconfigure(config, changes, casys, storage, replicator, timers):
+    """
+    Applying the changed settings. Only the affected parts are touched.
+    """
+    logger = logging.getLogger('Reconfigure')
+    if 'storage' in changes:
+        storage.set_paths(config['storage']['paths'])
+        if config['storage']['fragment_time'] != timers['fragment_time']:
+            timers['fragment_time'] = config['storage']['fragment_time']
+            logger.info('Fragmenting every {} seconds.'.format(timers['fragment_time']))
+            timers['fragment'].cancel()
+            timers['fragment'] = CasysAlignedTimer(timers['fragment_time'], casys.Fragment)
+    if 'replication' in changes:
+        try:
+            replicator.reconfigure(config['replication'])
+        except Exception:
+            logger.critical('Failed to restart the replication.', exc_info=True)
+    casys.reconfigure(config, changes)
+
+
+def cleaner(storage, config, replicator):
     logger = logging.getLogger('Cleaner')
-    expireTime = time() - VIDEO_EXPIRE_DURATION
-    logger.debug('Deleting files older than: {} ({})'.format(expireTime, strftime("%Y/%m/%d %H:%M:%S", localtime(expireTime))))
+    now = time()
+    logger.debug('Deleting expired files ({})'.format(strftime("%Y/%m/%d %H:%M:%S", localtime(now))))
     try:
-        for videoFile in os.listdir(VIDEO_STORAGE_PATH):
-            videoFile = os.path.join(VIDEO_STORAGE_PATH, videoFile)
-            if os.stat(videoFile).st_mtime < expireTime:
+        for videoFile in storage.files():
+            try:
+                mtime = os.stat(videoFile).st_mtime
+            except FileNotFoundError:
+                storage.forget(videoFile)
+                continue
+            device = os.path.basename(videoFile).split(' ')[0]
+            if mtime < now - config.camera(device)['retention']:
+                if config['replication']['enabled'] and config['replication']['delete_replicated_only'] and \
+                        videoFile.endswith(config['storage']['extension']) and \
+                        not replicator.is_replicated(videoFile):
+                    logger.debug('Keeping the expired file until it is replicated: ' + videoFile)
+                    continue
                 logger.info('Deleting expired files: ' + videoFile)
                 try:
-                    os.remove(videoFile)
+                    storage.remove(videoFile)
+                    replicator.forget(videoFile)
                 except OSError:
                     logger.exception("Failed to clean videos' directory.")
                 finally:
@@ -178,22 +261,6 @@ def cleaner(casys):
     finally:
         return True
 
-def CheckVideoDirectory():
-    logger = logging.getLogger('CheckVideoDirectory')
-    logger.debug("Attempting to create a 'dummy' file in the videos' directory")
-    try:
-        TmpFile = TemporaryFile(dir=VIDEO_STORAGE_PATH)
-        TmpFile.close()
-    except FileNotFoundError:
-        logger.info("Video directory does not exist. Creating it, and reruning the check.")
-        os.mkdir(VIDEO_STORAGE_PATH, 0o755)
-        CheckVideoDirectory()
-    except PermissionError:
-        logger.info("No write permission for the video directory. Attempting to fix, and reruning the check.")
-        os.chmod(VIDEO_STORAGE_PATH, 0o755)
-        CheckVideoDirectory()
-
-
 
 
 class LogParse(argparse.Action):
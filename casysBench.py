@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+#
+# Copyright 2020 Michael Israel
+#
+# This file is part of Casys.
+#
+# Casys is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Casys is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Casys.  If not, see <http://www.gnu.org/licenses/>.Copyright.
+"""
+Synthetic benchmark of Casys. N devices fed by videotestsrc (or a video file) run through the same
+pipelines as the cameras (recording, display and the other branches of CasysDevice) for a fixed
+duration, without any camera or display hardware. The results are printed as JSON.
+"""
+from casysControl import CasysDevice
+from casysStorage import CasysStoragePool
+from casysConfig import CasysConfig
+from casys_const import VERSION, EPILOG, BENCH_LATENCY_INTERVAL
+
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+from time import monotonic, time
+
+from gi.repository import Gst, GLib
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Casys synthetic benchmark', epilog=EPILOG,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--devices', type=int, default=1, help='number of devices', metavar='N')
+    parser.add_argument('-d', '--duration', type=int, default=30, help='measured seconds', metavar='sec')
+    parser.add_argument('--warmup', type=int, default=5, help='seconds before measuring', metavar='sec')
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--framerate', default='30/1')
+    parser.add_argument('--format', default='YUY2', help='raw video format of the source')
+    parser.add_argument('--pattern', default='ball', help='videotestsrc pattern')
+    parser.add_argument('--file', help='a video file to loop instead of videotestsrc', metavar='path')
+    parser.add_argument('--settings', default=os.devnull, help='settings file of the devices ([camera])', metavar='file')
+    parser.add_argument('--storage', help='directory of the recordings (temporary by default)', metavar='dir')
+    parser.add_argument('-o', '--output', help='write the JSON report to a file', metavar='file')
+    parser.add_argument('-l', '--log', default='warning', help='log level')
+    parser.add_argument('-v', '--version', action='version', version='%(prog)s {0}'.format(VERSION))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log.upper()), stream=sys.stderr,
+                        format='{asctime}: {levelname:9s}: {name:30s}: {message}', style='{')
+
+    directory = args.storage or tempfile.mkdtemp(prefix='casys-bench-')
+    try:
+        report = CasysBenchmark(args, directory).run()
+    finally:
+        if not args.storage:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            report_file.write(output + '\n')
+    else:
+        print(output)
+
+
+class CasysBenchmark():
+    def __init__(self, args, directory):
+        self._logger = logging.getLogger('CasysBenchmark')
+        self._args = args
+        self._config = CasysConfig(args.settings)
+        self._storage = CasysStoragePool([directory])
+        self._storage.check()
+        self._devices = []
+        self._latencies = []
+        self._expected = None
+        self._measuring = False
+        self._start = None
+
+    def _source(self, index):
+        caps = 'video/x-raw,format={},width={},height={},framerate={}'.format(
+            self._args.format, self._args.width, self._args.height, self._args.framerate)
+        if self._args.file:
+            return 'multifilesrc location="{}" loop=true ! decodebin ! videoconvert ! videoscale ! ' \
+                   'videorate ! {}'.format(self._args.file, caps)
+        return 'videotestsrc is-live=true pattern={} ! {}'.format(self._args.pattern, caps)
+
+    def run(self):
+        for index in range(self._args.devices):
+            device = CasysDevice('bench{}'.format(index), self._storage, self._config,
+                                 source=self._source(index))
+            device.CreatePipeline()
+            # Rendering on time, so that the frames a pipeline is too slow for are counted as dropped.
+            device.connectGui(None, sink='fakesink', sync=True)
+            device.Record(True)
+            self._devices.append(device)
+
+        loop = GLib.MainLoop()
+        GLib.timeout_add_seconds(self._args.warmup, self._begin)
+        GLib.timeout_add_seconds(self._args.warmup + self._args.duration, loop.quit)
+        self._expected = monotonic() + BENCH_LATENCY_INTERVAL / 1000
+        GLib.timeout_add(BENCH_LATENCY_INTERVAL, self._tick)
+        loop.run()
+
+        report = self._end()
+        for device in self._devices:
+            device.free()
+        return report
+
+    def _tick(self):
+        """
+        Measuring how late the main loop dispatches a periodic timer.
+        """
+        now = monotonic()
+        if self._measuring:
+            self._latencies.append(max(now - self._expected, 0) * 1000)
+        self._expected = now + BENCH_LATENCY_INTERVAL / 1000
+        return True
+
+    def _snapshot(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return {
+            'time': monotonic(),
+            'cpu': usage.ru_utime + usage.ru_stime,
+            'devices': {device.DeviceName: device.Metrics() for device in self._devices},
+            'bytes': {device.DeviceName: self._written(device) for device in self._devices},
+            }
+
+    def _written(self, device):
+        total = 0
+        for filename in self._storage.find(device.DeviceName):
+            try:
+                total += os.path.getsize(filename)
+            except OSError:
+                pass
+        return total
+
+    def _begin(self):
+        self._logger.info('Warmup done, measuring.')
+        self._start = self._snapshot()
+        self._measuring = True
+        return False
+
+    def _end(self):
+        end = self._snapshot()
+        start = self._start
+        elapsed = end['time'] - start['time']
+        pipelines = []
+        for device in self._devices:
+            name = device.DeviceName
+            before, after = start['devices'][name], end['devices'][name]
+            frames = after.get('frames', 0) - before.get('frames', 0)
+            pipelines.append({
+                'name': name,
+                'state': after['state'],
+                'fps': frames / elapsed,
+                'frames': frames,
+                'dropped': after.get('dropped', 0) - before.get('dropped', 0),
+                'qos': after['qos'] - before['qos'],
+                'bytes_written': end['bytes'][name] - start['bytes'][name],
+                'write_rate': (end['bytes'][name] - start['bytes'][name]) / elapsed,
+                })
+
+        latencies = sorted(self._latencies) or [0]
+        return {
+            'version': VERSION,
+            'gstreamer': Gst.version_string(),
+            'timestamp': time(),
+            'parameters': {
+                'devices': self._args.devices,
+                'duration': self._args.duration,
+                'width': self._args.width,
+                'height': self._args.height,
+                'framerate': self._args.framerate,
+                'format': self._args.format,
+                'source': self._source(0),
+                'camera': self._config.camera('bench0'),
+                },
+            'elapsed': elapsed,
+            'cpu_percent': 100 * (end['cpu'] - start['cpu']) / elapsed,
+            'cpu_count': os.cpu_count(),
+            'rss': self._rss(),
+            'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            'main_loop_latency_ms': {
+                'samples': len(self._latencies),
+                'mean': sum(latencies) / len(latencies),
+                'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+                'max': latencies[-1],
+                },
+            'pipelines': pipelines,
+            }
+
+    def _rss(self):
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+"""Call the main function"""
+if __name__ == "__main__":
+    main()
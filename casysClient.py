@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+#
+# Copyright 2020 Michael Israel
+#
+# This file is part of Casys.
+#
+# Casys is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Casys is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Casys.  If not, see <http://www.gnu.org/licenses/>.Copyright.
+"""
+Control client of Casys. Sends a single operation to the control server over its Unix socket
+and prints the result.
+"""
+from casys_const import CONTROL_SOCKET, VERSION, EPILOG
+
+import argparse
+import base64
+import json
+import socket
+import sys
+from time import mktime, strptime
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Casys control client', epilog=EPILOG,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-s', '--socket', default=CONTROL_SOCKET, help='the control socket', metavar='path')
+    parser.add_argument('-v', '--version', action='version', version='%(prog)s {0}'.format(VERSION))
+
+    operations = parser.add_subparsers(dest='op', metavar='operation')
+    operations.required = True
+    operations.add_parser('devices', help='list the devices')
+    operations.add_parser('metrics', help='show the devices and storage metrics')
+    operations.add_parser('storage', help='show the storage volumes')
+    operations.add_parser('profile', help='show the main-loop profile')
+    operations.add_parser('replication', help='show the replication queue')
+    for name, description in (('record', 'start recording a device'),
+                              ('stop', 'stop recording a device'),
+                              ('snapshot', 'save a snapshot of a device')):
+        operation = operations.add_parser(name, help=description)
+        operation.add_argument('device')
+    operation = operations.add_parser('fragment', help='start a new segment')
+    operation.add_argument('device', nargs='?')
+    operation = operations.add_parser('export', help='copy the segments of a device')
+    operation.add_argument('device')
+    operation.add_argument('target', nargs='?', help='a directory under the export path of the settings')
+    operation.add_argument('--start', type=parse_time, help='"YYYY-mm-dd HH:MM"', metavar='time')
+    operation.add_argument('--end', type=parse_time, help='"YYYY-mm-dd HH:MM"', metavar='time')
+    operation = operations.add_parser('timeline', help='list the thumbnails of a device')
+    operation.add_argument('device')
+    operation.add_argument('--start', type=parse_time, help='"YYYY-mm-dd HH:MM"', metavar='time')
+    operation.add_argument('--end', type=parse_time, help='"YYYY-mm-dd HH:MM"', metavar='time')
+    operation.add_argument('--step', type=float, help='seconds between the thumbnails', metavar='sec')
+    operation = operations.add_parser('thumbnail', help='save the thumbnail of a device closest to a time')
+    operation.add_argument('device')
+    operation.add_argument('time', type=parse_time, help='"YYYY-mm-dd HH:MM"')
+    operation.add_argument('output', help='the JPEG file to write')
+
+    args = vars(parser.parse_args())
+    socket_path = args.pop('socket')
+    op = args.pop('op')
+    output = args.pop('output', None)
+    args = {key: value for key, value in args.items() if value is not None}
+
+    try:
+        response = request(socket_path, op, args)
+    except OSError as e:
+        sys.exit('Failed to reach the control server at {}: {}'.format(socket_path, e))
+
+    if not response['ok']:
+        sys.exit(response['error'])
+    if output:
+        with open(output, 'wb') as output_file:
+            output_file.write(base64.b64decode(response['result']))
+        return
+    print(json.dumps(response['result'], indent=2))
+
+
+def parse_time(value):
+    try:
+        return mktime(strptime(value, '%Y-%m-%d %H:%M'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected "YYYY-mm-dd HH:MM", got "{}"'.format(value)) from None
+
+
+def request(socket_path, op, args):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        stream = connection.makefile('rw')
+        stream.write(json.dumps({'op': op, 'args': args}) + '\n')
+        stream.flush()
+        return json.loads(stream.readline())
+
+
+"""Call the main function"""
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,386 @@
+# Copyright 2020 Michael Israel
+#
+# This file is part of Casys.
+#
+# Casys is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Casys is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Casys.  If not, see <http://www.gnu.org/licenses/>.Copyright.
+"""
+Configuration of Casys. The settings file is an ini file validated against SCHEMA; the [camera]
+section holds the defaults of all cameras and a [camera:<name>] section overrides them for one
+camera. The file is reloaded on SIGHUP or when it changes, and only the changed settings are
+reported to the listeners.
+"""
+from casys_const import VIDEO_STORAGE_PATHS, EXTENSION, FRAGMENT_TIME, VIDEO_DEV_FILES_PATTERN, \
+    VIDEO_EXPIRE_DURATION, ENCODERS, CONFIG_POLL_TIME, CONTROL_SOCKET, CONTROL_HTTP_ADDRESS, \
+    CONTROL_HTTP_PORT, CONTROL_WORKERS, CONTROL_EXPORT_PATH, PROFILER_THRESHOLD, PROFILER_TRACERS, PROFILER_DUMP_FILE, \
+    SUPERVISOR_HEALTH_INTERVAL, SUPERVISOR_RESTART_DELAY, SUPERVISOR_MAX_RESTART_DELAY, \
+    THUMBNAIL_INTERVAL, THUMBNAIL_WIDTH, REPLICATION_QUEUE, REPLICATION_CONCURRENCY, REPLICATION_CHUNK_SIZE
+from casysabstraction import CasysObject, CasysBaseError
+import configparser
+import logging
+import os
+import signal
+from time import localtime
+
+WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+DAY_SETS = {
+    'daily': frozenset(range(7)),
+    'weekdays': frozenset(range(5)),
+    'weekends': frozenset((5, 6)),
+}
+
+
+def parse_list(value):
+    return [item.strip() for item in value.replace('\n', ',').split(',') if item.strip()]
+
+
+def parse_positive(value):
+    value = int(value)
+    if value <= 0:
+        raise ValueError('must be positive')
+    return value
+
+
+def parse_size(value):
+    value = int(value)
+    if value < 0:
+        raise ValueError('must not be negative')
+    return value
+
+
+def parse_bool(value):
+    try:
+        return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+    except KeyError:
+        raise ValueError('must be a boolean') from None
+
+
+def parse_framerate(value):
+    """
+    A framerate is given as a fraction ('15/2') or an integer, 0 leaving it to the camera.
+    """
+    numerator, _, denominator = value.partition('/')
+    numerator = parse_size(numerator)
+    denominator = parse_positive(denominator) if denominator else 1
+    return '{}/{}'.format(numerator, denominator)
+
+
+def parse_cpus(value):
+    """
+    A CPU set is given as in taskset ('0,2-3'), empty for all CPUs.
+    """
+    cpus = set()
+    for item in parse_list(value):
+        first, _, last = item.partition('-')
+        first = parse_size(first)
+        last = parse_size(last) if last else first
+        if last < first:
+            raise ValueError('has an empty range {}'.format(item))
+        cpus.update(range(first, last + 1))
+    return tuple(sorted(cpus))
+
+
+def parse_encoder(value):
+    if value != 'none' and value not in ENCODERS:
+        raise ValueError('must be one of none, {}'.format(', '.join(ENCODERS)))
+    return value
+
+
+def parse_days(value):
+    """
+    Days are daily, weekdays, weekends or a list of days and ranges ('mon-wed,sat').
+    """
+    if value in DAY_SETS:
+        return DAY_SETS[value]
+    days = set()
+    for item in parse_list(value):
+        first, _, last = item.partition('-')
+        try:
+            first = WEEKDAYS.index(first)
+            last = WEEKDAYS.index(last) if last else first
+        except ValueError:
+            raise ValueError('has invalid days {}'.format(item)) from None
+        days.update(day % 7 for day in range(first, last + 1 if last >= first else last + 8))
+    return frozenset(days)
+
+
+def parse_minute(value):
+    hours, _, minutes = value.partition(':')
+    minute = int(hours) * 60 + int(minutes or 0)
+    if not 0 <= minute <= 24 * 60:
+        raise ValueError('has an invalid time {}'.format(value))
+    return minute
+
+
+def parse_rule(value):
+    """
+    A schedule rule is '<profile> <days> <HH:MM>-<HH:MM> [<camera>,...]', returned as
+    (profile, days, start, end, cameras), start and end in minutes of the day. A rule ending
+    before it starts goes over midnight.
+    """
+    fields = value.split()
+    if len(fields) not in (3, 4):
+        raise ValueError('must be "<profile> <days> <HH:MM>-<HH:MM> [<camera>,...]"')
+    start, _, end = fields[2].partition('-')
+    cameras = tuple(parse_list(fields[3])) if len(fields) == 4 else ()
+    return (fields[0], parse_days(fields[1].lower()), parse_minute(start), parse_minute(end), cameras)
+
+
+def rule_matches(rule, camera, when):
+    """
+    Whether a schedule rule applies to a camera at a time (a struct_time).
+    """
+    _, days, start, end, cameras = rule
+    if cameras and camera not in cameras:
+        return False
+    minute = when.tm_hour * 60 + when.tm_min
+    if start < end:
+        return when.tm_wday in days and start <= minute < end
+    return (when.tm_wday in days and minute >= start) or \
+        ((when.tm_wday - 1) % 7 in days and minute < end)
+
+
+# Section -> option -> (parser, default).
+SCHEMA = {
+    'storage': {
+        'paths': (parse_list, VIDEO_STORAGE_PATHS),
+        'extension': (str, EXTENSION),
+        'fragment_time': (parse_positive, FRAGMENT_TIME),
+    },
+    'devices': {
+        'pattern': (str, VIDEO_DEV_FILES_PATTERN),
+    },
+    'control': {
+        'socket': (str, CONTROL_SOCKET),
+        'http_address': (str, CONTROL_HTTP_ADDRESS),
+        'http_port': (parse_size, CONTROL_HTTP_PORT),
+        'workers': (parse_positive, CONTROL_WORKERS),
+        'export_path': (str, CONTROL_EXPORT_PATH),
+        'token': (str, ''),
+    },
+    'profiler': {
+        'enabled': (parse_bool, False),
+        'threshold': (parse_positive, PROFILER_THRESHOLD),
+        'tracers': (str, PROFILER_TRACERS),
+        'dump_interval': (parse_size, 0),
+        'dump_file': (str, PROFILER_DUMP_FILE),
+    },
+    'supervisor': {
+        'enabled': (parse_bool, False),
+        'health_interval': (parse_positive, SUPERVISOR_HEALTH_INTERVAL),
+        'restart_delay': (parse_positive, SUPERVISOR_RESTART_DELAY),
+        'max_restart_delay': (parse_positive, SUPERVISOR_MAX_RESTART_DELAY),
+    },
+    'replication': {
+        'enabled': (parse_bool, False),
+        'target': (str, ''),
+        'endpoint': (str, ''),
+        'queue': (str, REPLICATION_QUEUE),
+        'concurrency': (parse_positive, REPLICATION_CONCURRENCY),
+        'bandwidth': (parse_size, 0),
+        'chunk_size': (parse_positive, REPLICATION_CHUNK_SIZE),
+        'delete_replicated_only': (parse_bool, False),
+    },
+    'camera': {
+        'width': (parse_size, 0),
+        'height': (parse_size, 0),
+        'framerate': (parse_framerate, '0/1'),
+        'encoder': (parse_encoder, 'none'),
+        'bitrate': (parse_positive, 2048),
+        'retention': (parse_positive, VIDEO_EXPIRE_DURATION),
+        'display': (parse_bool, True),
+        'cpus': (parse_cpus, ()),
+        'record': (parse_bool, True),
+        'motion_only': (parse_bool, False),
+        'thumbnail_interval': (parse_size, THUMBNAIL_INTERVAL),
+        'thumbnail_width': (parse_positive, THUMBNAIL_WIDTH),
+    },
+    'schedule': {},
+}
+
+# A profile overrides the camera settings it gives, while one of its schedule rules applies.
+PROFILE_OPTIONS = ('width', 'height', 'framerate', 'encoder', 'bitrate', 'display', 'record', 'motion_only')
+SCHEMA['profile'] = {option: (SCHEMA['camera'][option][0], None) for option in PROFILE_OPTIONS}
+
+# Sections which may be repeated with a name ([camera:<name>]), overriding the unnamed one.
+NAMED_SECTIONS = ('camera', 'profile')
+
+# Sections whose options are freely named, with the parser of their values.
+FREE_SECTIONS = {'schedule': parse_rule}
+
+
+class CasysConfig(CasysObject):
+    def __init__(self, filename):
+        super().__init__()
+        self._logger = logging.getLogger('CasysConfig')
+        self.Filename = filename
+        self._listeners = []
+        self._mtime = None
+        self._settings = self._read()
+
+    def _read(self):
+        """
+        Reading and validating the settings file. A missing file gives the defaults.
+        """
+        parser = configparser.ConfigParser(interpolation=None)
+        try:
+            self._mtime = os.stat(self.Filename).st_mtime
+            with open(self.Filename) as settings_file:
+                parser.read_file(settings_file)
+        except FileNotFoundError:
+            self._logger.warning('{} does not exist. Using the defaults.'.format(self.Filename))
+        except configparser.Error as e:
+            raise ConfigError(self.Filename, str(e)) from None
+
+        settings = {section: {} for section in SCHEMA}
+        for section in parser.sections():
+            kind, _, name = section.partition(':')
+            if kind not in SCHEMA or (name and kind not in NAMED_SECTIONS):
+                raise ConfigError(self.Filename, 'unknown section [{}]'.format(section))
+            values = settings.setdefault(section, {})
+            for option, value in parser.items(section):
+                try:
+                    option_parser = FREE_SECTIONS.get(kind) or SCHEMA[kind][option][0]
+                except KeyError:
+                    raise ConfigError(self.Filename, 'unknown option {} in [{}]'.format(
+                        option, section)) from None
+                try:
+                    values[option] = option_parser(value)
+                except ValueError as e:
+                    raise ConfigError(self.Filename, '{} in [{}] {}'.format(
+                        option, section, e)) from None
+
+        for section, options in SCHEMA.items():
+            for option, (_, default) in options.items():
+                settings[section].setdefault(option, default)
+
+        for name, rule in settings['schedule'].items():
+            if 'profile:' + rule[0] not in settings:
+                raise ConfigError(self.Filename, 'schedule {} uses an unknown profile {}'.format(name, rule[0]))
+        return settings
+
+    def __getitem__(self, section):
+        return self._settings[section]
+
+    def named(self, kind):
+        """
+        The names of all the [<kind>:<name>] sections.
+        """
+        prefix = kind + ':'
+        return [section[len(prefix):] for section in self._settings if section.startswith(prefix)]
+
+    def section(self, kind, name):
+        """
+        The settings of a named section, merged over the defaults of its kind.
+        """
+        settings = dict(self._settings[kind])
+        settings.update(self._settings.get(kind + ':' + name, {}))
+        return settings
+
+    def camera(self, name, when=None):
+        """
+        The settings of a camera, with the profile scheduled at the given time (now by default).
+        """
+        settings = self.section('camera', name)
+        profile = self.profile(name, when)
+        if profile is not None:
+            for option, value in self.section('profile', profile).items():
+                if value is not None:
+                    settings[option] = value
+        return settings
+
+    def profile(self, name, when=None):
+        """
+        The profile scheduled for a camera at the given time. The last matching rule wins.
+        """
+        when = localtime() if when is None else when
+        profile = None
+        for rule in self._settings['schedule'].values():
+            if rule_matches(rule, name, when):
+                profile = rule[0]
+        return profile
+
+    def connect(self, callback):
+        """
+        Registering callback(config, changes), called after each reload with the set of the changed
+        sections. A change in [<kind>] is reported as a change of all the [<kind>:<name>] sections.
+        """
+        self._listeners.append(callback)
+
+    def reload(self):
+        self._logger.info('Reloading {}.'.format(self.Filename))
+        try:
+            settings = self._read()
+        except ConfigError:
+            self._logger.error('Invalid settings. Keeping the current ones.', exc_info=True)
+            return
+
+        changes = set()
+        for section in set(self._settings) | set(settings):
+            if self._settings.get(section) != settings.get(section):
+                changes.add(section)
+        if any(section == 'schedule' or section.startswith('profile') for section in changes):
+            # The camera settings depend on the schedule.
+            changes.add('camera')
+        for kind in NAMED_SECTIONS:
+            if kind in changes:
+                changes.update(section for section in set(self._settings) | set(settings)
+                               if section.startswith(kind + ':'))
+
+        self._settings = settings
+        if not changes:
+            self._logger.debug('No setting was changed.')
+            return
+        self._logger.info('Changed sections: {}'.format(', '.join(sorted(changes))))
+        for callback in self._listeners:
+            try:
+                callback(self, changes)
+            except Exception:
+                self._logger.exception('Failed to apply the new settings.')
+
+    def watch(self):
+        """
+        Reloading on SIGHUP and when the settings file is modified.
+        """
+        from gi.repository import GLib
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGHUP, self._on_sighup)
+        GLib.timeout_add_seconds(CONFIG_POLL_TIME, self._poll)
+
+    def _on_sighup(self):
+        self._logger.info('SIGHUP received.')
+        self.reload()
+        return True
+
+    def _poll(self):
+        try:
+            mtime = os.stat(self.Filename).st_mtime
+        except FileNotFoundError:
+            return True
+        if mtime != self._mtime:
+            self.reload()
+        return True
+
+    def free(self):
+        pass
+
+
+class ConfigError(CasysBaseError):
+    def __init__(self, Filename=None, Reason=None):
+        self.__filename = Filename
+        self.__reason = Reason
+
+    def __str__(self):
+        if self.__reason is None:
+            return "Invalid settings file {}.".format(self.__filename)
+        else:
+            return "Invalid settings file {}: {}.".format(self.__filename, self.__reason)
@@ -15,65 +15,95 @@
 # You should have received a copy of the GNU General Public License
 # along with Casys.  If not, see <http://www.gnu.org/licenses/>.Copyright.
 
-from casys_const import VIDEO_DEV_FILES_PATTERN, EXTENSION, VIDEO_STORAGE_PATH
+from casys_const import MUX_CLUSTER_DURATION, ENCODERS, MOTION_CAPS, MOTION_POSTROLL, THUMBNAIL_QUALITY, \
+    STORAGE_REFRESH_TIME, DISPLAY_MAX_LATENESS
 import logging
 from glob import iglob
 from os import path
-from time import localtime, strftime
+from time import localtime, strftime, time
 from casysabstraction import CasysObject, CasysBaseError
+from casysStorage import NoVolumeError
+from casysRecovery import CasysSegmentFinalizer
+from casysThumbnails import CasysThumbnailWriter
+import casysProfiler
 import v4l2
 import fcntl
 
 import gi
 gi.require_version('Gst', '1.0')
 gi.require_version('GstVideo', '1.0')
-from gi.repository import Gst, GObject, GstVideo
+from gi.repository import Gst, GObject, GstVideo, GLib
 
 
 Gst.init(None)
 
 
+def is_capture_device(video_device, logger):
+    with open(video_device, "rb") as dev_file:
+        caps = v4l2.v4l2_capability()
+        ret_code = fcntl.ioctl(dev_file, v4l2.VIDIOC_QUERYCAP, caps)
+        if ret_code != 0:
+            logger.warning('Failed to read caps for {}.'.
+                           format(video_device))
+            return False
+        if (caps.reserved[0] & v4l2.V4L2_CAP_VIDEO_CAPTURE) == 0:
+            logger.info('{} does not support video capturing.'.
+                        format(video_device))
+            return False
+    return True
+
+
 class CasysControl(CasysObject):
-    def __init__(self):
+    def __init__(self, storage, config):
         super().__init__()
         self._logger = logging.getLogger('CasysControl')
         self._logger.debug('Initializing a CasysControl object.')
+        self._storage = storage
+        self._config = config
         self.__deviceList = CasysDevicesList()
+        self._started = False
         self.update()
 
     def update(self):
+        """
+        Adding the new devices matching the devices pattern, and removing those which no longer
+        match. Once recording, the new devices start recording too (without display).
+        """
         self._logger.debug('Finding new available camera devices.')
-        for video_device in iglob(VIDEO_DEV_FILES_PATTERN):
+        video_devices = list(iglob(self._config['devices']['pattern']))
+        for casysDev in list(self.__deviceList):
+            if casysDev.DevicePath not in video_devices:
+                self._logger.info('Removing {}. (no longer matching the devices pattern)'.
+                                  format(casysDev.DevicePath))
+                self.__deviceList.remove(casysDev)
+                casysDev.Close()
+                casysDev.free()
+
+        for video_device in video_devices:
             if video_device in self.__deviceList:
                 self._logger.debug('Skipping {}. (already added)'.
                                    format(video_device))
                 continue
 
-            with open(video_device, "rb") as dev_file:
-                caps = v4l2.v4l2_capability()
-                ret_code = fcntl.ioctl(dev_file, v4l2.VIDIOC_QUERYCAP, caps)
-                if ret_code != 0:
-                    self._logger.warning('Failed to read caps for {}.'.
-                                         format(video_device))
-                    continue
-                if (caps.reserved[0] & v4l2.V4L2_CAP_VIDEO_CAPTURE) == 0:
-                    self._logger.info('{} does not support video capturing.'.
-                                      format(video_device))
-                    continue
+            if not is_capture_device(video_device, self._logger):
+                continue
 
             self._logger.info('New video capturing device: {}.'.
                               format(video_device))
 
-            casysDev = CasysDevice(video_device)
+            casysDev = CasysDevice(video_device, self._storage, self._config)
 
             try:
                 casysDev.CreatePipeline()
-            except (CreateElementError, AddToPipelineError, LinkingElementsError):
+            except (CreateElementError, AddToPipelineError, LinkingElementsError, NoVolumeError):
                 self._logger.critical('An error was encountered while creating a CasysDevice for ' + video_device, exc_info=True)
                 del casysDev
                 continue
 
             self.__deviceList.append(casysDev)
+            if self._started:
+                casysDev.Start()
+                casysDev.Record(True)
 
         self._logger.debug("Currently {} detected camera devices.".format(len(self.__deviceList)))
 
@@ -112,23 +142,63 @@ class CasysControl(CasysObject):
         else:
             self._logger.debug("Attempting to start recording for all devices.")
             for dev in self.__deviceList:
-                dev.Fragment()
+                try:
+                    dev.Fragment()
+                except NoVolumeError:
+                    # Recording on in the current segment, until a volume is available.
+                    self._logger.error("No volume is available for a new segment of {}.".format(dev.DeviceName))
         return True
 
+    def reconfigure(self, config, changes):
+        """
+        Applying changed settings to the affected devices only.
+        """
+        for dev in self.__deviceList:
+            if 'camera:' + dev.DeviceName in changes or 'camera' in changes:
+                try:
+                    dev.Reconfigure(config.camera(dev.DeviceName))
+                except NoVolumeError:
+                    # Recording on in the current segment; the settings apply to the next one.
+                    self._logger.error("No volume is available for a new segment of {}.".format(dev.DeviceName))
+        if 'devices' in changes:
+            self.update()
+
+    def reschedule(self, device):
+        """
+        Switching a device to its scheduled settings when its next segment starts.
+        """
+        if type(device) is not CasysDevice:
+            device = self.__deviceList[device]
+        device.Reconfigure(self._config.camera(device.DeviceName), immediate=False)
+
     def record(self, device=None):
         """
         Start video recording from the detected Cameras to files.
         """
         if device:
-            if type(device) is CasysDevice:
-                device.Start()
-            else:
-                # Possibly propagated exceptions: ValueError, TypeError
-                self.__deviceList[device].Start()
+            if type(device) is not CasysDevice:
+                # Possibly propagated exceptions: KeyError, TypeError
+                device = self.__deviceList[device]
+            device.Start()
+            device.Record(True)
         else:
             self._logger.debug("Attempting to start recording for all devices.")
+            self._started = True
             for dev in self.__deviceList:
                 dev.Start()
+                dev.Record(True)
+
+    def stop_record(self, device):
+        """
+        Stop recording a device to files. The device is still displayed.
+        """
+        if type(device) is not CasysDevice:
+            # Possibly propagated exceptions: KeyError, TypeError
+            device = self.__deviceList[device]
+        device.Record(False)
+
+    def metrics(self):
+        return [dev.Metrics() for dev in self.__deviceList]
 
     '''
     def stream(self, coo):
@@ -249,6 +319,12 @@ class CasysDevicesList(list, CasysObject):
         self.__paths.append(element.DevicePath)
         list.append(self, element)
 
+    def remove(self, element):
+        index = self.__paths.index(element.DevicePath)
+        del self.__names[index]
+        del self.__paths[index]
+        list.__delitem__(self, index)
+
     def free(self):
         pass
 
@@ -273,6 +349,9 @@ class CasysDevicePipeline(CasysObject):
     def get_bus(self):
         return self._gstpipeline.get_bus()
 
+    def get_state(self, *args, **kwargs):
+        return self._gstpipeline.get_state(*args, **kwargs)
+
     def set_state(self, *args, **kwargs):
         return self._gstpipeline.set_state(*args, **kwargs)
 
@@ -289,7 +368,7 @@ class CasysDevicePipeline(CasysObject):
 
         try:
             set_property = element.set_property
-        except TypeError:
+        except (TypeError, AttributeError):
             raise CreateElementError(element_type) from None
 
         for key, value in properties.items():
@@ -313,24 +392,86 @@ class CasysDevicePipeline(CasysObject):
 
         return element
 
+    def add_bin(self, description, bin_name, link=True):
+        """
+        Adding a bin created from a gst-launch description, with ghost pads for its unlinked pads.
+        """
+        self._logger.info("Adding new bin {} ({}).".format(bin_name, description))
+        try:
+            element = Gst.parse_bin_from_description(description, True)
+        except GLib.Error:
+            raise CreateElementError(description) from None
+        element.set_name(bin_name)
+
+        if not self._gstpipeline.add(element):
+            raise AddToPipelineError(bin_name)
+
+        if link:
+            try:
+                last = self._last_element
+            except AttributeError:
+                pass
+            else:
+                if not last.link(element):
+                    raise LinkingElementsError(last, element)
+            finally:
+                self._last_element = element
+
+        return element
+
+    def remove_element(self, element):
+        self._logger.info("Removing element {}.".format(element.get_name()))
+        element.set_state(Gst.State.NULL)
+        self._gstpipeline.remove(element)
+
+    def link_elements(self, *elements):
+        for source, destination in zip(elements, elements[1:]):
+            if not source.link(destination):
+                raise LinkingElementsError(source, destination)
+
 
 class CasysDevice(CasysObject):
-    def __init__(self, video_device):
+    def __init__(self, video_device, storage, config, source=None):
         super().__init__()
         # TODO: Check existance or rely on creator?
         self._logger = logging.getLogger('CasysDevice ' + str(video_device))
         self._logger.debug('Initializing a new instance of CasysDevice')
         self.DevicePath = video_device
         self.DeviceName = path.basename(video_device)
+        self._storage = storage
+        self._config = config
+        self._settings = config.camera(self.DeviceName)
+        self._pending = None
+        self._record_requested = True
+        self._motion = False
+        self._motion_branch = []
+        self._postroll = None
+        self._resume_source = None
+        self._error = None
+        self._thumbnails = CasysThumbnailWriter()
+        self._finalizer = CasysSegmentFinalizer()
+        self._thumbnail_branch = []
+        self._gui_valve = None
+        self._imgsink = None
+        self._source = source
+        self._qos = 0
+        self.CurrentFile = None
 
     def CreatePipeline(self):
         # Creating Gstreamer elements.
         self._logger.debug('Creating pipeline-elements.')
         self._pipeline = CasysDevicePipeline('Pipeline_' + self.DeviceName)
-        self._pipeline.add_element('v4l2src',
-                                   'Camera_'+self.DeviceName,
-                                   device=self.DevicePath,
-                                   )
+        if self._source:
+            # A pipeline description replacing the camera (e.g. videotestsrc, for benchmarks).
+            self._pipeline.add_bin(self._source, 'Camera_'+self.DeviceName)
+        else:
+            self._pipeline.add_element('v4l2src',
+                                       'Camera_'+self.DeviceName,
+                                       device=self.DevicePath,
+                                       )
+        self._capsfilter = self._pipeline.add_element('capsfilter',
+                                                      'Caps_'+self.DeviceName,
+                                                      caps=self._caps())
         self._pipeline.add_element('clockoverlay', 'Clock_'+self.DeviceName)
         self._pipeline.add_element('textoverlay',
                                    'Title_'+self.DeviceName,
@@ -339,13 +480,42 @@ class CasysDevice(CasysObject):
                                    halignment="right",
                                    )
         self._tee = self._pipeline.add_element('tee', 'Tee_'+self.DeviceName)
-        self._pipeline.add_element('queue', 'FileQueue_'+self.DeviceName)
-        self._pipeline.add_element('matroskamux', 'Mux_'+self.DeviceName)
+        self._file_valve = self._pipeline.add_element('valve', 'FileValve_'+self.DeviceName)
+        self._file_queue = self._pipeline.add_element('queue', 'FileQueue_'+self.DeviceName)
+        self._encoder = self._add_encoder(link=True)
+        # Streamable matroska with short clusters keeps the segment playable if it is cut.
+        self._mux = self._pipeline.add_element('matroskamux',
+                                   'Mux_'+self.DeviceName,
+                                   streamable=True,
+                                   properties={"max-cluster-duration": MUX_CLUSTER_DURATION},
+                                   )
+        self.CurrentFile = self._generate_filename()
         self._filesink = self._pipeline.add_element(
             'filesink',
             'File_'+self.DeviceName,
-            location=self._generate_filename(),
+            location=self.CurrentFile,
             )
+        self._storage.register(self.CurrentFile, recording=True)
+
+        # Keeping the last frame for snapshots.
+        snapshot_queue = self._pipeline.add_element('queue',
+                                                    'SnapshotQueue_'+self.DeviceName,
+                                                    link=False,
+                                                    leaky=2,
+                                                    properties={"max-size-buffers": 1})
+        self._snapshot_sink = self._pipeline.add_element('fakesink',
+                                                         'Snapshot_'+self.DeviceName,
+                                                         link=False,
+                                                         sync=False,
+                                                         properties={"enable-last-sample": True})
+        self._pipeline.link_elements(self._tee, snapshot_queue, self._snapshot_sink)
+
+        if self._settings['motion_only']:
+            self._add_motion_branch()
+        self._update_valve()
+        if self._settings['thumbnail_interval']:
+            self._add_thumbnail_branch()
+        self._open_thumbnails(self.CurrentFile)
 
         # Getting the bus.
         self._logger.debug('Getting the bus of this pipeline.')
@@ -354,9 +524,247 @@ class CasysDevice(CasysObject):
 
         # Connecting the bus to the handler.
         bus.add_signal_watch()
-        bus.connect('message', self.__message_handler)
+        bus.connect('message', casysProfiler.wrap('Bus_'+self.DeviceName, self.__message_handler))
         bus.connect('sync-message::element', self._sync_message_handler)
 
+    def _caps(self):
+        caps = 'video/x-raw'
+        if self._settings['width']:
+            caps += ',width={}'.format(self._settings['width'])
+        if self._settings['height']:
+            caps += ',height={}'.format(self._settings['height'])
+        if not self._settings['framerate'].startswith('0/'):
+            caps += ',framerate={}'.format(self._settings['framerate'])
+        return Gst.Caps.from_string(caps)
+
+    def _add_encoder(self, link):
+        """
+        Adding the converter and encoder of the recording branch.
+        Returns the elements added, an empty list for raw recording.
+        """
+        encoder = self._settings['encoder']
+        if encoder == 'none':
+            return []
+        bitrate_property, multiplier = ENCODERS[encoder]
+        properties = {}
+        if bitrate_property:
+            properties[bitrate_property] = self._settings['bitrate'] * multiplier
+        elements = [self._pipeline.add_element('videoconvert', 'FileConverter_'+self.DeviceName, link=link)]
+        try:
+            elements.append(self._pipeline.add_element(encoder, 'Encoder_'+self.DeviceName, link=link,
+                                                       properties=properties))
+        except (CreateElementError, AddToPipelineError, LinkingElementsError):
+            self._pipeline.remove_element(elements[0])
+            raise
+        return elements
+
+    def _replace_encoder(self):
+        """
+        Replacing the converter and encoder between the file queue and the muxer. Called while the
+        pipeline is stopped. Falls back to raw recording if the new encoder cannot be set up.
+        """
+        self._logger.debug('Replacing the encoder.')
+        # Releasing the muxer's sink pad; a pad left without data would stall the muxer.
+        upstream = self._encoder[-1] if self._encoder else self._file_queue
+        src_pad = upstream.get_static_pad('src')
+        mux_pad = src_pad.get_peer()
+        if mux_pad is not None:
+            src_pad.unlink(mux_pad)
+            self._mux.release_request_pad(mux_pad)
+        for element in self._encoder:
+            self._pipeline.remove_element(element)
+        self._encoder = []
+        try:
+            self._encoder = self._add_encoder(link=False)
+            self._pipeline.link_elements(self._file_queue, *self._encoder, self._mux)
+        except (CreateElementError, AddToPipelineError, LinkingElementsError):
+            self._logger.critical('Failed to set up the encoder {}. Recording raw video.'.format(
+                self._settings['encoder']), exc_info=True)
+            for element in self._encoder:
+                self._pipeline.remove_element(element)
+            self._encoder = []
+            self._pipeline.link_elements(self._file_queue, self._mux)
+
+    def Reconfigure(self, settings, immediate=True):
+        """
+        Applying new camera settings. Display and bitrate changes are applied on the fly, changes
+        needing a renegotiation are applied by starting a new segment, immediately or when the
+        next one starts.
+        """
+        old = self._settings
+        if settings == old and self._pending is None:
+            return
+        self._logger.info("Reconfiguring: {}".format(settings))
+
+        if settings['display'] != old['display'] and self._gui_valve is not None:
+            self._gui_valve.set_property('drop', not settings['display'])
+
+        renegotiate = any(settings[key] != old[key] for key in ('width', 'height', 'framerate', 'encoder', 'motion_only',
+                                                                'thumbnail_interval', 'thumbnail_width'))
+        if not renegotiate and settings['bitrate'] != old['bitrate'] and self._encoder:
+            bitrate_property, multiplier = ENCODERS[settings['encoder']]
+            if bitrate_property:
+                self._encoder[-1].set_property(bitrate_property, settings['bitrate'] * multiplier)
+
+        self._pending = settings
+        try:
+            if immediate and renegotiate:
+                self.Fragment()
+            elif not renegotiate:
+                self._settings = settings
+                self._pending = None
+        finally:
+            if settings['record'] != old['record']:
+                self._update_valve(settings)
+
+    def _apply_pending(self):
+        """
+        Applying pending settings. Called while the pipeline is stopped.
+        """
+        settings, self._pending = self._pending, None
+        old, self._settings = self._settings, settings
+        self._capsfilter.set_property('caps', self._caps())
+        if settings['encoder'] != old['encoder']:
+            self._replace_encoder()
+        elif settings['bitrate'] != old['bitrate'] and self._encoder:
+            bitrate_property, multiplier = ENCODERS[settings['encoder']]
+            if bitrate_property:
+                self._encoder[-1].set_property(bitrate_property, settings['bitrate'] * multiplier)
+        if settings['motion_only'] != old['motion_only']:
+            if settings['motion_only']:
+                self._add_motion_branch()
+            else:
+                self._remove_motion_branch()
+            self._update_valve()
+        if settings['thumbnail_interval'] != old['thumbnail_interval'] or \
+                settings['thumbnail_width'] != old['thumbnail_width']:
+            self._remove_branch(self._thumbnail_branch)
+            self._thumbnail_branch = []
+            if settings['thumbnail_interval']:
+                self._add_thumbnail_branch()
+
+    def _add_branch(self, branch):
+        """
+        Adding a branch of (element type, name prefix, properties) after the tee.
+        Returns the elements added; those already added are removed if one fails.
+        """
+        elements = []
+        try:
+            for element_type, prefix, properties in branch:
+                elements.append(self._pipeline.add_element(
+                    element_type, prefix+self.DeviceName, link=False, properties=properties))
+            self._pipeline.link_elements(self._tee, *elements)
+        except (CreateElementError, AddToPipelineError, LinkingElementsError):
+            self._remove_branch(elements)
+            raise
+        return elements
+
+    def _remove_branch(self, elements):
+        if elements:
+            tee_pad = elements[0].get_static_pad('sink').get_peer()
+            if tee_pad is not None:
+                self._tee.release_request_pad(tee_pad)
+        for element in elements:
+            self._pipeline.remove_element(element)
+
+    def _add_thumbnail_branch(self):
+        """
+        Adding the timeline thumbnails branch: a JPEG of the video every thumbnail_interval seconds.
+        Frames are dropped before they are scaled, so the branch costs little.
+        """
+        self._logger.debug('Adding the thumbnails branch.')
+        caps = 'video/x-raw,format=I420,width={},pixel-aspect-ratio=1/1,framerate=1/{}'.format(
+            self._settings['thumbnail_width'], self._settings['thumbnail_interval'])
+        try:
+            self._thumbnail_branch = self._add_branch((
+                ('queue', 'ThumbnailQueue_', {'leaky': 2, 'max-size-buffers': 1}),
+                ('videorate', 'ThumbnailRate_', {'drop-only': True}),
+                ('videoscale', 'ThumbnailScale_', {}),
+                ('videoconvert', 'ThumbnailConverter_', {}),
+                ('capsfilter', 'ThumbnailCaps_', {'caps': Gst.Caps.from_string(caps)}),
+                ('jpegenc', 'ThumbnailEncoder_', {'quality': THUMBNAIL_QUALITY}),
+                ('appsink', 'ThumbnailSink_', {'emit-signals': True, 'sync': False,
+                                               'max-buffers': 1, 'drop': True}),
+                ))
+        except (CreateElementError, AddToPipelineError, LinkingElementsError):
+            self._logger.error('Failed to add the thumbnails branch.', exc_info=True)
+            self._thumbnail_branch = []
+            return
+        self._thumbnail_branch[-1].connect('new-sample', self._on_thumbnail)
+
+    def _on_thumbnail(self, sink):
+        """
+        Called from the streaming thread.
+        """
+        sample = sink.emit('pull-sample')
+        if sample is not None:
+            buf = sample.get_buffer()
+            self._thumbnails.append(time(), buf.extract_dup(0, buf.get_size()))
+        return Gst.FlowReturn.OK
+
+    def _open_thumbnails(self, segment):
+        if not self._thumbnail_branch:
+            return
+        for filename in self._thumbnails.open(segment) or ():
+            self._storage.register(filename)
+
+    def _add_motion_branch(self):
+        """
+        Adding the motion detection branch, on a downscaled copy of the video.
+        """
+        self._logger.debug('Adding the motion detection branch.')
+        self._motion = False
+        try:
+            self._motion_branch = self._add_branch((
+                ('queue', 'MotionQueue_', {'leaky': 2, 'max-size-buffers': 1}),
+                ('videoconvert', 'MotionConverter_', {}),
+                ('videoscale', 'MotionScale_', {}),
+                ('capsfilter', 'MotionCaps_', {'caps': Gst.Caps.from_string(MOTION_CAPS)}),
+                ('motioncells', 'Motion_', {'display': False}),
+                ('fakesink', 'MotionSink_', {'sync': False, 'async': False}),
+                ))
+        except (CreateElementError, AddToPipelineError, LinkingElementsError):
+            self._logger.error('Motion detection is not available. Recording continuously.', exc_info=True)
+            self._motion_branch = []
+            self._motion = True
+
+    def _remove_motion_branch(self):
+        if self._postroll is not None:
+            GLib.source_remove(self._postroll)
+            self._postroll = None
+        if self._motion_branch:
+            self._logger.debug('Removing the motion detection branch.')
+        self._remove_branch(self._motion_branch)
+        self._motion_branch = []
+
+    def _on_motion(self, structure):
+        if structure.has_field('motion_begin'):
+            self._logger.info('Motion detected.')
+            if self._postroll is not None:
+                GLib.source_remove(self._postroll)
+                self._postroll = None
+            self._motion = True
+            self._update_valve()
+        elif structure.has_field('motion_finished') and self._postroll is None:
+            self._postroll = GLib.timeout_add_seconds(MOTION_POSTROLL, self._end_motion)
+
+    def _end_motion(self):
+        self._logger.info('Motion finished.')
+        self._postroll = None
+        self._motion = False
+        self._update_valve()
+        return False
+
+    def _update_valve(self, settings=None):
+        """
+        Opening the recording branch when recording is requested, enabled by the settings, and
+        for motion-only recording, while there is motion.
+        """
+        settings = settings or self._settings
+        record = self._record_requested and settings['record'] and \
+            (not settings['motion_only'] or self._motion or not self._motion_branch)
+        self._file_valve.set_property('drop', not record)
+
     def _sync_message_handler(self, bus, msg):
         print(msg)
         print(msg.src)
@@ -389,12 +797,24 @@ class CasysDevice(CasysObject):
             self._logger.info("GstMessage {}: Stream-Start received from {}".format(msg.seqnum, msg.src.get_name()))
 
         elif msg.type == Gst.MessageType.QOS:
-            # TODO: Implement.
+            self._qos += 1
             self._logger.info("GstMessage {}: QOS of {}".format(msg.seqnum, msg.src.get_name()))
 
+        elif msg.type == Gst.MessageType.ELEMENT and msg.get_structure().get_name() == 'motion':
+            self._on_motion(msg.get_structure())
+
         elif msg.type == Gst.MessageType.ERROR:
             [gerr, debug] = msg.parse_error()
             self._logger.critical("GstMessage {}: Error {} in {}:\n{}\n  -->{}".format(msg.seqnum, gerr.code, msg.src.get_name(), gerr.message, debug))
+            if msg.src == self._filesink:
+                self._logger.error("Writing to {} failed. Moving to another volume.".format(self.CurrentFile))
+                self._storage.volume_failed(self.CurrentFile, gerr.message)
+                try:
+                    self.Fragment()
+                except NoVolumeError:
+                    self._wait_for_volume()
+            else:
+                self._error = "{}: {}".format(msg.src.get_name(), gerr.message)
 
         else:
             mstruct = msg.get_structure()
@@ -414,30 +834,45 @@ class CasysDevice(CasysObject):
                 errMsg += "\n    #{} - {} = {}".format(i, f, val)
             self._logger.fatal(errMsg)
 
-    def connectGui(self, xid):
+    def connectGui(self, xid, sink='xvimagesink', sync=False):
+        """
+        Displaying the device in the window xid. With sync, the sink renders on time and drops the
+        late frames (reported by Metrics() as dropped, and by QoS messages), e.g. to measure how
+        far a pipeline falls behind.
+        """
         self._logger.debug("Connecting to XID: " + str(xid))
         self._logger.debug("Geting the tee element from the pipeline")
 
         queue = self._pipeline.add_element('queue',
                                            'GuiQueue_'+self.DeviceName,
                                            link=False)
+        self._gui_valve = self._pipeline.add_element('valve',
+                                                     'GuiValve_'+self.DeviceName,
+                                                     link=False,
+                                                     drop=not self._settings['display'])
         vidconv = self._pipeline.add_element('videoconvert',
                                              'converter_'+self.DeviceName,
                                              link=False)
+        properties = {"force-aspect-ratio": True} if xid is not None else {}
+        if sync:
+            properties.update({"qos": True, "max-lateness": DISPLAY_MAX_LATENESS})
         imgsink = self._pipeline.add_element(
-            'xvimagesink',
+            sink,
             'Imagesink_'+self.DeviceName,
             link=False,
-            sync=0,
-            properties={"force-aspect-ratio": True})
+            sync=sync,
+            properties=properties)
+        self._imgsink = imgsink
 
         self._logger.debug("Linking the new elements.")
         self._tee.link(queue)
-        queue.link(vidconv)
+        queue.link(self._gui_valve)
+        self._gui_valve.link(vidconv)
         vidconv.link(imgsink)
 
-        self._logger.debug("Connecting the video to the corresponding xid")
-        imgsink.set_window_handle(xid)
+        if xid is not None:
+            self._logger.debug("Connecting the video to the corresponding xid")
+            imgsink.set_window_handle(xid)
 
         self._logger.debug("Setting the whole pipeline to playing.")
         self._pipeline.set_state(Gst.State.PLAYING)
@@ -453,30 +888,136 @@ class CasysDevice(CasysObject):
         self._logger.debug("Playing device.")
         self._pipeline.set_state(Gst.State.PLAYING)
 
+    def Record(self, enable):
+        self._logger.debug("Recording: {}".format(enable))
+        self._record_requested = enable
+        self._update_valve()
+
+    @property
+    def Recording(self):
+        return not self._file_valve.get_property('drop')
+
+    def Snapshot(self):
+        """
+        The last frame of the device, as a GstSample. See snapshot_to_png().
+        """
+        sample = self._snapshot_sink.get_property('last-sample')
+        if sample is None:
+            raise SnapshotError(self.DeviceName)
+        return sample
+
+    def Metrics(self):
+        _, state, _ = self._pipeline.get_state(0)
+        try:
+            written = path.getsize(self.CurrentFile)
+        except (OSError, TypeError):
+            written = 0
+        metrics = {
+            'name': self.DeviceName,
+            'path': self.DevicePath,
+            'state': state.value_nick,
+            'recording': self.Recording,
+            'file': self.CurrentFile,
+            'bytes': written,
+            'qos': self._qos,
+            'error': self._error,
+            'thumbnails': list(self._thumbnails.Files or ()),
+            }
+        if self._imgsink is not None:
+            stats = self._imgsink.get_property('stats')
+            metrics['frames'] = stats.get_value('rendered')
+            metrics['dropped'] = stats.get_value('dropped')
+        return metrics
+
     def Fragment(self):
         self._logger.debug("Fragmenting video files")
+        # Switching to the scheduled settings on the segment boundary.
+        self.Reconfigure(self._config.camera(self.DeviceName), immediate=False)
         # outfile = self.__pipeline.get_by_name('File' + self.DeviceName)
         new_name = self._generate_filename()
         self.Stop()
+        self._thumbnails.close()
+        self._finalize(self.CurrentFile)
+        if self._pending is not None:
+            try:
+                self._apply_pending()
+            except Exception:
+                # Recording on with what could be set up rather than staying stopped.
+                self._logger.critical("Failed to apply the new settings.", exc_info=True)
+        self.CurrentFile = new_name
         self._filesink.set_property('location', new_name)
+        self._storage.register(new_name, recording=True)
+        self._open_thumbnails(new_name)
+        self._error = None
         self.Start()
+        if self._resume_source is not None:
+            GLib.source_remove(self._resume_source)
+            self._resume_source = None
+
+    def Close(self):
+        """
+        Stopping for good, completing the current segment.
+        """
+        self.Stop()
+        self._thumbnails.close()
+        if self.CurrentFile is not None:
+            self._finalize(self.CurrentFile)
+            self.CurrentFile = None
+
+    def _wait_for_volume(self):
+        """
+        Stopping until the storage has a volume again (see CasysStoragePool.refresh()).
+        """
+        if self._resume_source is None:
+            self._logger.critical("No volume is left for recording. Waiting for one.")
+            self.Stop()
+            self._resume_source = GLib.timeout_add_seconds(STORAGE_REFRESH_TIME, self._resume)
+
+    def _resume(self):
+        source, self._resume_source = self._resume_source, None
+        try:
+            self.Fragment()
+        except NoVolumeError:
+            self._resume_source = source
+            return True
+        self._logger.info("A volume is available again. Recording.")
+        return False
+
+    def _finalize(self, filename):
+        """
+        Filling in the sizes of a closed segment, which the streamable muxer leaves unknown, off
+        the main loop. The segment counts as complete once finalized.
+        """
+        self._finalizer.finalize(filename, lambda filename: GLib.idle_add(self._segment_finalized, filename))
+
+    def _segment_finalized(self, filename):
+        self._storage.segment_closed(filename)
+        return False
 
     def free(self):
         self._logger.debug('Deleting the CasysDevice')
+        if self._resume_source is not None:
+            GLib.source_remove(self._resume_source)
+            self._resume_source = None
         self.Stop()
+        self._thumbnails.free()
+        # The segments being finalized still are.
+        self._finalizer.free()
         try:
             self._pipeline.free()
         except AttributeError:
             pass
 
     def _generate_filename(self):
+        extension = self._config['storage']['extension']
         current_time = strftime("%Y-%m-%d-%H", localtime())
         self._logger.debug("Creating a new file name at '" + current_time + "'.")
         for index in self.__counter():
-            filename = path.join(VIDEO_STORAGE_PATH, self.DeviceName + ' ' + current_time + index + EXTENSION)
-            if path.exists(filename):
-                self._logger.warning("File " + filename + " already exists.")
+            basename = self.DeviceName + ' ' + current_time + index + extension
+            if self._storage.exists(basename):
+                self._logger.warning("File " + basename + " already exists.")
             else:
+                filename = self._storage.allocate(basename)
                 self._logger.debug('Using: ' + filename)
                 return filename
 
@@ -488,6 +1029,15 @@ class CasysDevice(CasysObject):
             i += 1
 
 
+def snapshot_to_png(sample):
+    """
+    Encoding a snapshot to PNG. Blocking, so better called off the main loop.
+    """
+    png = GstVideo.video_convert_sample(sample, Gst.Caps.from_string('image/png'), Gst.CLOCK_TIME_NONE)
+    buf = png.get_buffer()
+    return buf.extract_dup(0, buf.get_size())
+
+
 class CreateElementError(CasysBaseError):
     def __init__(self, Name=None):
         self.__name = str(Name)
@@ -524,3 +1074,14 @@ class LinkingElementsError(CasysBaseError):
             return "Error occured while linking to destination {}.".format(self.__destElement)
         else:
             return "Error occured while linking source {} to destination {}.".format(self.__srcElement, self.__destElement)
+
+
+class SnapshotError(CasysBaseError):
+    def __init__(self, Name=None):
+        self.__name = Name
+
+    def __str__(self):
+        if self.__name is None:
+            return "No frame is available for a snapshot."
+        else:
+            return "No frame of {} is available for a snapshot.".format(self.__name)
@@ -0,0 +1,311 @@
+# Copyright 2020 Michael Israel
+#
+# This file is part of Casys.
+#
+# Casys is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Casys is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Casys.  If not, see <http://www.gnu.org/licenses/>.Copyright.
+"""
+Main-loop profiler of Casys (opt-in). Every GLib source and bus handler is timed into a histogram,
+and a watchdog thread samples the stack of any callback running longer than the threshold. The
+records of the GStreamer tracers (latency, proctime, framerate, ...) are aggregated into the same
+report. Nothing is wrapped unless install() was called.
+"""
+from casys_const import PROFILER_BUCKETS, PROFILER_SLOW_KEEP, PROFILER_HEARTBEAT
+from casysabstraction import CasysObject
+from collections import deque
+import json
+import logging
+import sys
+import threading
+import traceback
+from time import monotonic, sleep, time
+
+from gi.repository import GLib, GObject, Gst
+
+# GLib function -> position of the callback in its arguments (the first callable argument for the
+# deprecated signatures, e.g. io_add_watch(fd, condition, callback)).
+WRAPPED_SOURCES = {
+    'idle_add': 0,
+    'timeout_add': 1,
+    'timeout_add_seconds': 1,
+    'unix_signal_add': 2,
+    'io_add_watch': 3,
+}
+
+# Tracer record -> (fields naming the measured object, measured field, scale to ms).
+TRACER_FIELDS = {
+    'latency': (('src', 'sink'), 'time', 1e-6),
+    'element-latency': (('element',), 'time', 1e-6),
+    'proctime': (('element',), 'time', 1e-6),
+    'framerate': (('pad',), 'fps', 1),
+    'bitrate': (('pad',), 'bitrate', 1),
+    'thread-rusage': (('thread-id',), 'average-cpuload', 0.1),
+}
+
+_profiler = None
+
+
+def wrap(name, func):
+    """
+    Wrapping a callback of the main loop (e.g. a bus handler) for profiling.
+    Returns func itself when the profiler is not installed.
+    """
+    if _profiler is None:
+        return func
+    return _profiler.wrap(name, func)
+
+
+def install(threshold, tracers=''):
+    """
+    Installing the profiler. Must be called before the sources to profile are added.
+    """
+    global _profiler
+    if _profiler is None:
+        _profiler = CasysProfiler(threshold)
+        _profiler.start()
+        if tracers:
+            _profiler.attach_tracers(tracers)
+    return _profiler
+
+
+def get():
+    return _profiler
+
+
+class CasysStatistics():
+    """
+    Count, total, maximum and a power of two histogram (in ms) of a measure.
+    """
+    def __init__(self):
+        self.Count = 0
+        self.Total = 0.0
+        self.Max = 0.0
+        self.Histogram = [0] * (len(PROFILER_BUCKETS) + 1)
+
+    def add(self, value):
+        self.Count += 1
+        self.Total += value
+        self.Max = max(self.Max, value)
+        for index, bound in enumerate(PROFILER_BUCKETS):
+            if value < bound:
+                break
+        else:
+            index = len(PROFILER_BUCKETS)
+        self.Histogram[index] += 1
+
+    def report(self):
+        labels = ['<{}'.format(bound) for bound in PROFILER_BUCKETS] + ['>={}'.format(PROFILER_BUCKETS[-1])]
+        return {
+            'count': self.Count,
+            'total': self.Total,
+            'mean': self.Total / self.Count if self.Count else 0,
+            'max': self.Max,
+            'histogram': {label: count for label, count in zip(labels, self.Histogram) if count},
+            }
+
+
+class CasysProfiler(CasysObject):
+    def __init__(self, threshold):
+        super().__init__()
+        self._logger = logging.getLogger('CasysProfiler')
+        self.Threshold = threshold
+        self._lock = threading.Lock()
+        self._callbacks = {}
+        self._tracers = {}
+        self._tracer_objects = []
+        self._lateness = CasysStatistics()
+        self._slow = deque(maxlen=PROFILER_SLOW_KEEP)
+        self._running = {}
+        self._originals = {}
+        self._expected = None
+        self._watchdog = None
+        self._started = time()
+
+    def start(self):
+        self._logger.info('Profiling the main loop (threshold {} ms).'.format(self.Threshold))
+        for name, position in WRAPPED_SOURCES.items():
+            self._patch(name, position)
+        self._expected = monotonic() + PROFILER_HEARTBEAT / 1000
+        self._originals['timeout_add'](PROFILER_HEARTBEAT, self._heartbeat)
+        self._watchdog = threading.Thread(target=self._watch, name='CasysProfiler', daemon=True)
+        self._watchdog.start()
+
+    def _patch(self, name, position):
+        original = getattr(GLib, name)
+        self._originals[name] = original
+
+        def patched(*args, **kwargs):
+            args = list(args)
+            if position >= len(args) or not callable(args[position]):
+                callbacks = [index for index, arg in enumerate(args) if callable(arg)]
+                if not callbacks:
+                    return original(*args, **kwargs)
+                callback = callbacks[0]
+            else:
+                callback = position
+            args[callback] = self.wrap(self._describe(args[callback]), args[callback])
+            return original(*args, **kwargs)
+
+        setattr(GLib, name, patched)
+
+    def _describe(self, func):
+        name = getattr(func, '__qualname__', None) or repr(func)
+        code = getattr(func, '__code__', None)
+        if code is not None and name.endswith('<lambda>'):
+            name += ' ({}:{})'.format(code.co_filename, code.co_firstlineno)
+        return name
+
+    def wrap(self, name, func):
+        def profiled(*args, **kwargs):
+            key = threading.get_ident()
+            start = monotonic()
+            self._running[key] = [name, start, False]
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = (monotonic() - start) * 1000
+                sampled = self._running.pop(key, [None, None, True])[2]
+                with self._lock:
+                    try:
+                        statistics = self._callbacks[name]
+                    except KeyError:
+                        statistics = self._callbacks[name] = CasysStatistics()
+                    statistics.add(elapsed)
+                    if elapsed >= self.Threshold and not sampled:
+                        self._slow.append({'callback': name, 'time': time(), 'duration': elapsed,
+                                           'stack': None})
+                if elapsed >= self.Threshold:
+                    self._logger.warning('{} blocked the main loop for {:.1f} ms.'.format(name, elapsed))
+
+        profiled.__qualname__ = name
+        return profiled
+
+    def _heartbeat(self):
+        """
+        Measuring how late the main loop dispatches a periodic timer, which includes the time
+        spent in sources that are not wrapped (e.g. GTK events).
+        """
+        now = monotonic()
+        with self._lock:
+            self._lateness.add(max(now - self._expected, 0) * 1000)
+        self._expected = now + PROFILER_HEARTBEAT / 1000
+        return True
+
+    def _watch(self):
+        """
+        Sampling the stack of the callbacks running longer than the threshold.
+        """
+        period = max(self.Threshold / 2000, 0.005)
+        while True:
+            sleep(period)
+            now = monotonic()
+            frames = None
+            for key, running in list(self._running.items()):
+                name, start, sampled = running
+                if sampled or (now - start) * 1000 < self.Threshold:
+                    continue
+                if frames is None:
+                    frames = sys._current_frames()
+                try:
+                    stack = traceback.format_stack(frames[key])
+                except KeyError:
+                    continue
+                running[2] = True
+                with self._lock:
+                    self._slow.append({'callback': name, 'time': time(), 'duration': (now - start) * 1000,
+                                       'stack': ''.join(stack)})
+                self._logger.warning('{} is running for more than {} ms:\n{}'.format(
+                    name, self.Threshold, ''.join(stack)))
+
+    def attach_tracers(self, tracers):
+        """
+        Creating GStreamer tracers ('name(params);name...', as in GST_TRACERS) and collecting
+        their records through the GStreamer log.
+        """
+        registry = Gst.Registry.get()
+        for tracer in tracers.split(';'):
+            name, _, params = tracer.strip().partition('(')
+            if not name:
+                continue
+            factory = registry.lookup_feature(name)
+            if not isinstance(factory, Gst.TracerFactory):
+                self._logger.warning('No GStreamer tracer named {}.'.format(name))
+                continue
+            properties = {'params': params.rstrip(')')} if params else {}
+            self._tracer_objects.append(GObject.new(factory.get_tracer_type(), **properties))
+            self._logger.info('Attached the GStreamer tracer {}.'.format(tracer.strip()))
+
+        # The records are only logged at TRACE level, several per buffer: the default handler would
+        # print all of them on stderr. It is replaced, the other categories (GST_DEBUG) being
+        # forwarded to it.
+        Gst.debug_set_threshold_for_name('GST_TRACER', Gst.DebugLevel.TRACE)
+        Gst.debug_remove_log_function(None)
+        Gst.debug_add_log_function(self._gst_log, None)
+
+    def _gst_log(self, category, level, filename, function, line, obj, message, *user_data):
+        # Called for each record from the streaming threads: as little work as possible before
+        # knowing the record is aggregated.
+        if category.get_name() != 'GST_TRACER':
+            Gst.debug_log_default(category, level, filename, function, line, obj, message, None)
+            return
+        if level != Gst.DebugLevel.TRACE:
+            return
+        text = message.get()
+        if text.partition(',')[0] not in TRACER_FIELDS:
+            return
+        structure = Gst.Structure.from_string(text)
+        if isinstance(structure, tuple):
+            structure = structure[0]
+        if structure is None:
+            return
+        record = structure.get_name()
+        try:
+            key_fields, value_field, scale = TRACER_FIELDS[record]
+        except KeyError:
+            return
+        if not structure.has_field(value_field):
+            return
+        key = record + ' ' + ' -> '.join(str(structure.get_value(field)) for field in key_fields
+                                         if structure.has_field(field))
+        value = structure.get_value(value_field) * scale
+        with self._lock:
+            try:
+                statistics = self._tracers[key]
+            except KeyError:
+                statistics = self._tracers[key] = CasysStatistics()
+            statistics.add(value)
+
+    def report(self):
+        with self._lock:
+            callbacks = sorted(self._callbacks.items(), key=lambda item: item[1].Total, reverse=True)
+            return {
+                'since': self._started,
+                'threshold': self.Threshold,
+                'main_loop_lateness': self._lateness.report(),
+                'callbacks': {name: statistics.report() for name, statistics in callbacks},
+                'slow': list(self._slow),
+                'tracers': {name: statistics.report() for name, statistics in sorted(self._tracers.items())},
+                }
+
+    def dump(self, filename):
+        self._logger.debug('Dumping the profile to {}.'.format(filename))
+        try:
+            with open(filename, 'w') as dump_file:
+                json.dump(self.report(), dump_file, indent=2)
+        except OSError:
+            self._logger.exception('Failed to dump the profile.')
+        return True
+
+    def free(self):
+        for name, original in self._originals.items():
+            setattr(GLib, name, original)
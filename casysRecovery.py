@@ -0,0 +1,277 @@
+# Copyright 2020 Michael Israel
+#
+# This file is part of Casys.
+#
+# Casys is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Casys is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Casys.  If not, see <http://www.gnu.org/licenses/>.Copyright.
+"""
+Recovery of video segments. Segments are written as streamable matroska (no seeking back, every
+cluster is self contained), so a segment cut by a crash or a power loss only lacks its sizes and
+possibly ends with a truncated block. Recovering it only needs its head, its tail and the headers
+of its last cluster: the partial block is cut off and the unknown sizes of the segment and of the
+last cluster are filled in. The last cluster is searched in the tail of the file, or found by
+walking the headers of all the elements when the clusters are larger (e.g. of raw video).
+"""
+from casys_const import RECOVERY_TAIL_SIZE, RECOVERY_MAX_SCAN
+from casysabstraction import CasysObject, CasysBaseError
+import concurrent.futures
+import logging
+import os
+
+EBML_ID = 0x1A45DFA3
+SEGMENT_ID = 0x18538067
+CLUSTER_ID = 0x1F43B675
+CLUSTER_TIMESTAMP_ID = 0xE7
+CLUSTER_ID_BYTES = CLUSTER_ID.to_bytes(4, 'big')
+# Top-level elements that may follow a cluster (Cluster, Cues, Tags, Chapters, Attachments).
+TOP_LEVEL_IDS = (CLUSTER_ID, 0x1C53BB6B, 0x1254C367, 0x1043A770, 0x1941A469)
+
+
+def read_vint(data, offset, keep_marker=False):
+    """
+    Decoding an EBML variable size integer. Returning (value, length, unknown), unknown being
+    True for the reserved all-ones value used for elements of unknown size.
+    """
+    try:
+        first = data[offset]
+    except IndexError:
+        raise CorruptSegmentError('Truncated variable size integer.') from None
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first & mask:
+        mask >>= 1
+        length += 1
+    if length > 8:
+        raise CorruptSegmentError('Invalid variable size integer at {}.'.format(offset))
+    if offset + length > len(data):
+        raise CorruptSegmentError('Truncated variable size integer.')
+    value = first if keep_marker else first & (mask - 1)
+    for byte in data[offset + 1:offset + length]:
+        value = (value << 8) | byte
+    unknown = not keep_marker and value == (1 << (7 * length)) - 1
+    return value, length, unknown
+
+
+def write_vint(value, length):
+    if value >= (1 << (7 * length)) - 1:
+        raise CorruptSegmentError('{} does not fit in a {} bytes size.'.format(value, length))
+    return ((1 << (7 * length)) | value).to_bytes(length, 'big')
+
+
+class CasysSegmentRecovery(CasysObject):
+    def __init__(self):
+        super().__init__()
+        self._logger = logging.getLogger('CasysSegmentRecovery')
+
+    def recover(self, filename):
+        """
+        Checking a segment and repairing it if it was left incomplete.
+        Returns True if the segment was repaired.
+        """
+        with open(filename, 'r+b') as segment:
+            file_size = os.fstat(segment.fileno()).st_size
+            head = segment.read(4096)
+            size_offset, size_length, data_start, data_size, unknown = self._parse_head(head)
+
+            if not unknown and data_start + data_size == file_size:
+                self._logger.debug('{} is complete.'.format(filename))
+                return False
+
+            self._logger.info('{} was left incomplete. Scanning its tail.'.format(filename))
+            cluster_start = self._find_last_cluster(segment, data_start, file_size)
+            end, cluster_size_field = self._walk_cluster(segment, cluster_start, file_size)
+
+            if end < file_size:
+                self._logger.info('Cutting {} bytes of a partial block off {}.'.format(
+                    file_size - end, filename))
+                segment.truncate(end)
+
+            if cluster_size_field is not None:
+                field_offset, field_length, children_start = cluster_size_field
+                segment.seek(field_offset)
+                segment.write(write_vint(end - children_start, field_length))
+
+            segment.seek(size_offset)
+            segment.write(write_vint(end - data_start, size_length))
+
+        self._logger.info('{} recovered ({} bytes).'.format(filename, end))
+        return True
+
+    def _parse_head(self, head):
+        ebml_id, id_length, _ = read_vint(head, 0, keep_marker=True)
+        if ebml_id != EBML_ID:
+            raise CorruptSegmentError('Not a matroska file.')
+        header_size, size_length, _ = read_vint(head, id_length)
+        offset = id_length + size_length + header_size
+
+        segment_id, id_length, _ = read_vint(head, offset, keep_marker=True)
+        if segment_id != SEGMENT_ID:
+            raise CorruptSegmentError('No segment follows the EBML header.')
+        size_offset = offset + id_length
+        data_size, size_length, unknown = read_vint(head, size_offset)
+        return size_offset, size_length, size_offset + size_length, data_size, unknown
+
+    def _find_last_cluster(self, segment, data_start, file_size):
+        """
+        Searching backwards from the end of the file for the start of the last valid cluster,
+        reading a window which doubles up to RECOVERY_MAX_SCAN, then walking the headers.
+        """
+        window = RECOVERY_TAIL_SIZE
+        searched_from = file_size
+        while True:
+            start = max(data_start, file_size - window)
+            segment.seek(start)
+            tail = segment.read(file_size - start)
+
+            position = len(tail)
+            while True:
+                position = tail.rfind(CLUSTER_ID_BYTES, 0, position)
+                if position < 0:
+                    break
+                if start + position < searched_from and self._is_cluster(tail, position):
+                    return start + position
+            searched_from = start
+
+            if start == data_start:
+                raise CorruptSegmentError('No cluster was found.')
+            if window >= RECOVERY_MAX_SCAN:
+                return self._walk_clusters(segment, data_start, file_size)
+            window *= 2
+
+    def _walk_clusters(self, segment, data_start, file_size):
+        """
+        Finding the start of the last cluster from the start of the segment data, reading only the
+        headers of the elements: those of unknown size (the clusters) by their children.
+        """
+        self._logger.debug('Walking the clusters from the start of the segment.')
+        last = None
+        offset = data_start
+        while offset < file_size:
+            segment.seek(offset)
+            header = segment.read(12)
+            try:
+                element_id, id_length, _ = read_vint(header, 0, keep_marker=True)
+                size, size_length, unknown = read_vint(header, id_length)
+            except CorruptSegmentError:
+                break
+            if element_id == CLUSTER_ID:
+                last = offset
+                if unknown:
+                    offset += id_length + size_length
+                    continue
+            elif unknown:
+                break
+            offset += id_length + size_length + size
+        if last is None:
+            raise CorruptSegmentError('No cluster was found.')
+        return last
+
+    def _is_cluster(self, data, offset):
+        try:
+            offset += 4
+            _, size_length, _ = read_vint(data, offset)
+            child_id, _, _ = read_vint(data, offset + size_length, keep_marker=True)
+        except CorruptSegmentError:
+            return False
+        return child_id == CLUSTER_TIMESTAMP_ID
+
+    def _walk_cluster(self, segment, cluster_start, file_size):
+        """
+        Walking the children of the last cluster by their headers only.
+        Returns the end of the last complete child, and the size field of the cluster if it
+        has to be filled in.
+        """
+        segment.seek(cluster_start)
+        header = segment.read(12)
+        size, size_length, unknown = read_vint(header, 4)
+        children_start = cluster_start + 4 + size_length
+
+        if not unknown and children_start + size <= file_size:
+            return children_start + size, None
+
+        end = children_start
+        while end < file_size:
+            segment.seek(end)
+            header = segment.read(12)
+            try:
+                child_id, id_length, _ = read_vint(header, 0, keep_marker=True)
+                if child_id in TOP_LEVEL_IDS:
+                    break
+                child_size, child_size_length, child_unknown = read_vint(header, id_length)
+            except CorruptSegmentError:
+                break
+            child_end = end + id_length + child_size_length + child_size
+            if child_unknown or child_end > file_size:
+                break
+            end = child_end
+
+        if end == children_start:
+            # Nothing usable in this cluster.
+            return cluster_start, None
+        return end, (cluster_start + 4, size_length, children_start)
+
+    def scan(self, storage, extension):
+        """
+        Recovering every segment of the storage. Called at startup, before recording starts.
+        """
+        for filename in storage.files():
+            if not filename.endswith(extension):
+                continue
+            try:
+                if self.recover(filename):
+                    storage.register(filename)
+            except (OSError, CorruptSegmentError):
+                self._logger.warning('Failed to recover {}.'.format(filename), exc_info=True)
+
+    def free(self):
+        pass
+
+
+class CasysSegmentFinalizer(CasysObject):
+    """
+    Filling in the sizes of the closed segments (see CasysSegmentRecovery), which the streamable
+    muxer leaves unknown, one at a time in a thread of its own so that reading their tail does not
+    hold the main loop. done(filename) is called from that thread once a segment is finalized.
+    """
+    def __init__(self):
+        super().__init__()
+        self._logger = logging.getLogger('CasysSegmentFinalizer')
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                               thread_name_prefix='CasysSegmentFinalizer')
+
+    def finalize(self, filename, done):
+        self._executor.submit(self._finalize, filename, done)
+
+    def _finalize(self, filename, done):
+        try:
+            CasysSegmentRecovery().recover(filename)
+        except (OSError, CorruptSegmentError):
+            self._logger.warning('Failed to finalize {}.'.format(filename), exc_info=True)
+        try:
+            done(filename)
+        except Exception:
+            self._logger.exception('Failed to report {} as finalized.'.format(filename))
+
+    def free(self):
+        self._executor.shutdown(wait=False)
+
+
+class CorruptSegmentError(CasysBaseError):
+    def __init__(self, Reason=None):
+        self.__reason = Reason
+
+    def __str__(self):
+        if self.__reason is None:
+            return "The segment cannot be recovered."
+        else:
+            return "The segment cannot be recovered: {}".format(self.__reason)
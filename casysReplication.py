@@ -0,0 +1,583 @@
+# Copyright 2020 Michael Israel
+#
+# This file is part of Casys.
+#
+# Casys is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Casys is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Casys.  If not, see <http://www.gnu.org/licenses/>.Copyright.
+"""
+Offsite replication of Casys. Complete segments are put in a persistent queue (SQLite), and an
+asyncio loop in its own thread uploads them to a target:
+ - a local (or mounted) directory: /path or file:///path
+ - an S3-compatible service: s3://bucket/prefix (with the endpoint setting for e.g. MinIO)
+ - an SFTP server: sftp://user@host:port/path
+The uploads are chunked and resumed after a failure or a restart from the last chunk written,
+shaped by a token bucket, and verified by checksums before a segment counts as replicated.
+"""
+from casys_const import REPLICATION_POLL_TIME, REPLICATION_RETRY_TIME, REPLICATION_MAX_RETRY_TIME, \
+    S3_MIN_PART_SIZE
+from casysabstraction import CasysObject, CasysBaseError
+import asyncio
+import base64
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import shlex
+import sqlite3
+import threading
+from time import monotonic, time
+from urllib.parse import urlsplit, unquote
+
+
+def file_sha256(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as source:
+        for block in iter(lambda: source.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_chunk(filename, offset, size):
+    with open(filename, 'rb') as source:
+        source.seek(offset)
+        return source.read(size)
+
+
+def create_target(settings):
+    """
+    The target of the target setting.
+    """
+    url = urlsplit(settings['target'])
+    if url.scheme in ('', 'file'):
+        if not url.path:
+            raise ReplicationError('No replication target is set.')
+        return CasysLocalTarget(unquote(url.path))
+    if url.scheme == 's3':
+        return CasysS3Target(url.hostname, unquote(url.path).strip('/'), settings['endpoint'] or None)
+    if url.scheme == 'sftp':
+        return CasysSFTPTarget(url.hostname, url.port or 22, url.username, unquote(url.path) or '.')
+    raise ReplicationError('Unknown replication target {}.'.format(settings['target']))
+
+
+class CasysReplicationQueue(CasysObject):
+    """
+    The persistent queue of the segments to replicate, and of those replicated. Used from the
+    main loop and from the replication thread.
+    """
+    def __init__(self, filename):
+        super().__init__()
+        self._logger = logging.getLogger('CasysReplicationQueue')
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._lock, self._db:
+            self._db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                filename TEXT PRIMARY KEY,
+                state TEXT NOT NULL DEFAULT 'pending',
+                size INTEGER,
+                sha256 TEXT,
+                offset INTEGER NOT NULL DEFAULT 0,
+                target_state TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_try REAL NOT NULL DEFAULT 0,
+                error TEXT,
+                enqueued REAL,
+                replicated REAL)''')
+
+    def _execute(self, statement, *parameters):
+        with self._lock, self._db:
+            return self._db.execute(statement, parameters).fetchall()
+
+    def enqueue(self, *filenames):
+        now = time()
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR IGNORE INTO jobs (filename, enqueued) VALUES (?, ?)',
+                                 [(filename, now) for filename in filenames])
+
+    def get(self, filename):
+        rows = self._execute('SELECT * FROM jobs WHERE filename = ?', filename)
+        return dict(rows[0]) if rows else None
+
+    def due(self, limit, exclude=()):
+        """
+        The pending jobs to try now, oldest first.
+        """
+        rows = self._execute("SELECT * FROM jobs WHERE state = 'pending' AND next_try <= ? "
+                             "ORDER BY enqueued LIMIT ?", time(), limit + len(exclude))
+        return [dict(row) for row in rows if row['filename'] not in exclude][:limit]
+
+    def restart(self, filename, size, sha256):
+        """
+        Starting a job over, e.g. for a segment which changed since it was queued.
+        """
+        self._execute('UPDATE jobs SET size = ?, sha256 = ?, offset = 0, target_state = NULL '
+                      'WHERE filename = ?', size, sha256, filename)
+
+    def progress(self, filename, offset, target_state):
+        self._execute('UPDATE jobs SET offset = ?, target_state = ? WHERE filename = ?',
+                      offset, target_state, filename)
+
+    def done(self, filename):
+        self._execute("UPDATE jobs SET state = 'done', replicated = ?, error = NULL, target_state = NULL "
+                      "WHERE filename = ?", time(), filename)
+
+    def retry(self, filename, error):
+        """
+        Delaying a failed job, twice as long after each failure.
+        """
+        job = self.get(filename)
+        if job is None:
+            return None
+        delay = min(REPLICATION_RETRY_TIME * 2 ** job['attempts'], REPLICATION_MAX_RETRY_TIME)
+        self._execute('UPDATE jobs SET attempts = attempts + 1, next_try = ?, error = ? WHERE filename = ?',
+                      time() + delay, error, filename)
+        return delay
+
+    def forget(self, filename):
+        self._execute('DELETE FROM jobs WHERE filename = ?', filename)
+
+    def is_replicated(self, filename):
+        rows = self._execute("SELECT 1 FROM jobs WHERE filename = ? AND state = 'done'", filename)
+        return bool(rows)
+
+    def metrics(self):
+        metrics = {state: {'segments': count, 'bytes': size or 0} for state, count, size in
+                   self._execute('SELECT state, COUNT(*), SUM(size) FROM jobs GROUP BY state')}
+        metrics['failing'] = [dict(row) for row in self._execute(
+            "SELECT filename, attempts, error, next_try FROM jobs WHERE state = 'pending' AND attempts > 0 "
+            "ORDER BY enqueued")]
+        return metrics
+
+    def free(self):
+        with self._lock:
+            self._db.close()
+
+
+class CasysTokenBucket():
+    """
+    Limiting the rate (bytes/s, 0 for none) of the uploads together. The bucket holds a second of
+    tokens; the uploads keep their chunks about that size (see chunk_size()) so that each is sent
+    right after its tokens, rather than in bursts. A larger chunk is let through once the bucket
+    has refilled for it.
+    """
+    def __init__(self, rate):
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        self.Rate = rate
+        self._tokens = rate
+        self._last = monotonic()
+
+    def chunk_size(self, size, minimum, shares=1):
+        """
+        The size of the chunks of shares uploads together, at most size and at least minimum.
+        """
+        if not self.Rate:
+            return max(size, minimum)
+        return max(min(size, self.Rate // shares), minimum)
+
+    async def consume(self, amount):
+        if not self.Rate:
+            return
+        now = monotonic()
+        self._tokens = min(self.Rate, self._tokens + (now - self._last) * self.Rate)
+        self._last = now
+        self._tokens -= amount
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.Rate)
+
+
+class CasysReplicationTarget(CasysObject):
+    """
+    A replication target. Its methods run in worker threads:
+     - resume(name, size, sha256, offset, state) -> (offset, state): where to continue an upload
+       given the offset and state saved after the last chunk (offset 0 and state None at first).
+     - write(name, state, offset, data) -> state: writing a chunk.
+     - finish(name, state, size, sha256): completing and verifying an upload.
+    The state must be JSON serializable.
+    """
+    MinChunkSize = 1
+
+    def free(self):
+        pass
+
+
+class CasysLocalTarget(CasysReplicationTarget):
+    def __init__(self, path):
+        super().__init__()
+        self._logger = logging.getLogger('CasysLocalTarget')
+        self.Path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _part(self, name):
+        return os.path.join(self.Path, name + '.part')
+
+    def resume(self, name, size, sha256, offset, state):
+        try:
+            written = os.path.getsize(self._part(name))
+        except FileNotFoundError:
+            return 0, None
+        if written > offset:
+            # Written after the last saved progress; written again.
+            os.truncate(self._part(name), offset)
+        return min(written, offset), None
+
+    def write(self, name, state, offset, data):
+        with open(self._part(name), 'r+b' if offset else 'wb') as part:
+            part.seek(offset)
+            part.write(data)
+            part.flush()
+            os.fsync(part.fileno())
+        return state
+
+    def finish(self, name, state, size, sha256):
+        part = self._part(name)
+        if os.path.getsize(part) != size or file_sha256(part) != sha256:
+            os.remove(part)
+            raise ChecksumError(name)
+        os.replace(part, os.path.join(self.Path, name))
+
+
+class CasysS3Target(CasysReplicationTarget):
+    """
+    Multipart uploads, one part per chunk. Each part is checked by the service against its MD5,
+    the whole segment against its size and the SHA-256 kept in the object's metadata.
+    """
+    MinChunkSize = S3_MIN_PART_SIZE
+
+    def __init__(self, bucket, prefix, endpoint=None):
+        super().__init__()
+        self._logger = logging.getLogger('CasysS3Target')
+        try:
+            import boto3
+        except ImportError:
+            raise ReplicationError('S3 targets need boto3.') from None
+        self.Bucket = bucket
+        self.Prefix = prefix
+        self._client = boto3.client('s3', endpoint_url=endpoint)
+
+    def _key(self, name):
+        return self.Prefix + '/' + name if self.Prefix else name
+
+    def resume(self, name, size, sha256, offset, state):
+        if state is not None:
+            try:
+                self._client.list_parts(Bucket=self.Bucket, Key=self._key(name), UploadId=state['upload_id'])
+                return sum(part['Size'] for part in state['parts']), state
+            except self._client.exceptions.NoSuchUpload:
+                self._logger.warning('The upload of {} expired, starting over.'.format(name))
+        upload = self._client.create_multipart_upload(Bucket=self.Bucket, Key=self._key(name),
+                                                      Metadata={'sha256': sha256})
+        return 0, {'upload_id': upload['UploadId'], 'parts': []}
+
+    def write(self, name, state, offset, data):
+        number = len(state['parts']) + 1
+        md5 = base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+        response = self._client.upload_part(Bucket=self.Bucket, Key=self._key(name), UploadId=state['upload_id'],
+                                            PartNumber=number, Body=data, ContentMD5=md5)
+        state['parts'].append({'PartNumber': number, 'ETag': response['ETag'], 'Size': len(data)})
+        return state
+
+    def finish(self, name, state, size, sha256):
+        key = self._key(name)
+        if state['parts']:
+            self._client.complete_multipart_upload(
+                Bucket=self.Bucket, Key=key, UploadId=state['upload_id'],
+                MultipartUpload={'Parts': [{'PartNumber': part['PartNumber'], 'ETag': part['ETag']}
+                                           for part in state['parts']]})
+        else:
+            # An empty segment; a multipart upload needs at least one part.
+            self._client.abort_multipart_upload(Bucket=self.Bucket, Key=key, UploadId=state['upload_id'])
+            self._client.put_object(Bucket=self.Bucket, Key=key, Body=b'', Metadata={'sha256': sha256})
+        head = self._client.head_object(Bucket=self.Bucket, Key=key)
+        if head['ContentLength'] != size or head['Metadata'].get('sha256') != sha256:
+            raise ChecksumError(name)
+
+
+class CasysSFTPTarget(CasysReplicationTarget):
+    """
+    Uploading over SFTP, authenticated by the SSH agent or the default keys. The checksum is
+    computed by sha256sum on the server, or by reading the upload back when it has no shell.
+    """
+    def __init__(self, host, port, username, path):
+        super().__init__()
+        self._logger = logging.getLogger('CasysSFTPTarget')
+        try:
+            import paramiko
+        except ImportError:
+            raise ReplicationError('SFTP targets need paramiko.') from None
+        self.Path = path
+        self._lock = threading.Lock()
+        self._ssh = paramiko.SSHClient()
+        self._ssh.load_system_host_keys()
+        self._connect = lambda: self._ssh.connect(host, port=port, username=username)
+        self._sftp = None
+
+    def _client(self):
+        """
+        The SFTP session, reconnected if it was lost.
+        """
+        transport = self._ssh.get_transport()
+        if self._sftp is None or transport is None or not transport.is_active():
+            self._connect()
+            self._sftp = self._ssh.open_sftp()
+        return self._sftp
+
+    def _part(self, name):
+        return self.Path.rstrip('/') + '/' + name + '.part'
+
+    def resume(self, name, size, sha256, offset, state):
+        with self._lock:
+            sftp = self._client()
+            try:
+                written = sftp.stat(self._part(name)).st_size
+            except FileNotFoundError:
+                return 0, None
+            if written > offset:
+                sftp.truncate(self._part(name), offset)
+            return min(written, offset), None
+
+    def write(self, name, state, offset, data):
+        with self._lock:
+            with self._client().open(self._part(name), 'r+' if offset else 'w') as part:
+                part.seek(offset)
+                part.write(data)
+        return state
+
+    def finish(self, name, state, size, sha256):
+        with self._lock:
+            sftp = self._client()
+            part = self._part(name)
+            if sftp.stat(part).st_size != size or self._sha256(sftp, part) != sha256:
+                sftp.remove(part)
+                raise ChecksumError(name)
+            sftp.posix_rename(part, self.Path.rstrip('/') + '/' + name)
+
+    def _sha256(self, sftp, filename):
+        try:
+            _, stdout, _ = self._ssh.exec_command('sha256sum ' + shlex.quote(filename))
+            return stdout.read().decode().split()[0]
+        except Exception:
+            self._logger.warning('No sha256sum on the server, reading {} back.'.format(filename))
+        digest = hashlib.sha256()
+        with sftp.open(filename, 'r') as remote:
+            for block in iter(lambda: remote.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def free(self):
+        self._ssh.close()
+
+
+class CasysReplicator(CasysObject):
+    """
+    Uploading the queued segments, concurrency of them at a time, in an asyncio loop of its own.
+    segments() lists the complete segments, queued when starting.
+    """
+    def __init__(self, settings, segments=None):
+        super().__init__()
+        self._logger = logging.getLogger('CasysReplicator')
+        self._settings = settings
+        self._segments = segments
+        self._queue = None
+        self._target = None
+        self._bucket = CasysTokenBucket(settings['bandwidth'] * 125)
+        self._loop = None
+        self._thread = None
+        self._wakeup = None
+        self._active = {}
+
+    @property
+    def Running(self):
+        return self._loop is not None and self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._logger.info('Replicating to {}.'.format(self._settings['target']))
+        self._queue = self._queue or CasysReplicationQueue(self._settings['queue'])
+        if self._segments is not None:
+            # The segments closed while not replicating (those already replicated are kept).
+            self._queue.enqueue(*self._segments())
+        self._target = create_target(self._settings)
+        self._loop = asyncio.new_event_loop()
+        self._loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(thread_name_prefix='CasysReplicator'))
+        self._thread = threading.Thread(target=self._run, args=(self._loop, self._target, self._thread),
+                                        name='CasysReplicator', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stopping the uploads. Those interrupted resume from their last chunk when started again.
+        Called from the main loop, so it does not wait for a chunk being written (which may take
+        long on a stalled connection); a replication started again waits for it in its thread.
+        """
+        if self._loop is not None:
+            self._logger.info('Stopping the replication.')
+            try:
+                self._loop.call_soon_threadsafe(self._cancel)
+            except RuntimeError:
+                # The loop already stopped.
+                pass
+            self._loop = None
+            self._wakeup = None
+
+    def _cancel(self):
+        for task in asyncio.all_tasks():
+            task.cancel()
+
+    def reconfigure(self, settings):
+        old, self._settings = self._settings, settings
+        self._bucket.set_rate(settings['bandwidth'] * 125)
+        if any(settings[key] != old[key] for key in ('enabled', 'target', 'endpoint', 'queue', 'chunk_size')):
+            self.stop()
+            if settings['queue'] != old['queue'] and self._queue is not None:
+                self._queue.free()
+                self._queue = None
+            if settings['enabled']:
+                self.start()
+        else:
+            self._wake()
+
+    def _run(self, loop, target, previous):
+        if previous is not None:
+            # The chunks the previous replication is still writing would be written again.
+            previous.join()
+        self._active.clear()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self._main())
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            self._logger.exception('The replication stopped.')
+        finally:
+            loop.run_until_complete(loop.shutdown_default_executor())
+            loop.close()
+            target.free()
+
+    async def _main(self):
+        self._wakeup = asyncio.Event()
+        while True:
+            free = self._settings['concurrency'] - len(self._active)
+            if free > 0:
+                for job in self._queue.due(free, exclude=self._active):
+                    task = asyncio.ensure_future(self._replicate(job))
+                    self._active[job['filename']] = task
+                    task.add_done_callback(lambda _, filename=job['filename']: self._done(filename))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), REPLICATION_POLL_TIME)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def _done(self, filename):
+        self._active.pop(filename, None)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _wake(self):
+        loop, wakeup = self._loop, self._wakeup
+        if loop is not None and wakeup is not None:
+            try:
+                loop.call_soon_threadsafe(wakeup.set)
+            except RuntimeError:
+                pass
+
+    def _worker(self, func, *args):
+        return asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    async def _replicate(self, job):
+        filename = job['filename']
+        name = os.path.basename(filename)
+        try:
+            try:
+                size = os.path.getsize(filename)
+            except FileNotFoundError:
+                self._logger.warning('{} is gone, dropping it from the queue.'.format(filename))
+                self._queue.forget(filename)
+                return
+            if job['sha256'] is None or job['size'] != size:
+                sha256 = await self._worker(file_sha256, filename)
+                self._queue.restart(filename, size, sha256)
+                job = self._queue.get(filename)
+
+            state = json.loads(job['target_state']) if job['target_state'] else None
+            offset, state = await self._worker(self._target.resume, name, size, job['sha256'],
+                                               job['offset'], state)
+            if offset:
+                self._logger.info('Resuming {} at {} bytes.'.format(name, offset))
+            while offset < size:
+                chunk_size = self._bucket.chunk_size(self._settings['chunk_size'], self._target.MinChunkSize,
+                                                     self._settings['concurrency'])
+                data = await self._worker(read_chunk, filename, offset, chunk_size)
+                if not data:
+                    raise ReplicationError('{} was truncated.'.format(filename))
+                await self._bucket.consume(len(data))
+                state = await self._worker(self._target.write, name, state, offset, data)
+                offset += len(data)
+                self._queue.progress(filename, offset, json.dumps(state))
+
+            await self._worker(self._target.finish, name, state, size, job['sha256'])
+            self._queue.done(filename)
+            self._logger.info('Replicated {}.'.format(name))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            delay = self._queue.retry(filename, str(e) or type(e).__name__)
+            self._logger.warning('Failed to replicate {}, retrying in {} seconds.'.format(name, delay),
+                                 exc_info=True)
+
+    def enqueue(self, *filenames):
+        """
+        Queuing complete segments. Called from the main loop, e.g. as a storage listener.
+        """
+        if self._queue is None:
+            return
+        self._logger.debug('Queuing {}.'.format(', '.join(filenames)))
+        self._queue.enqueue(*filenames)
+        self._wake()
+
+    def is_replicated(self, filename):
+        return self._queue is not None and self._queue.is_replicated(filename)
+
+    def forget(self, filename):
+        if self._queue is not None:
+            self._queue.forget(filename)
+
+    def metrics(self):
+        metrics = {'target': self._settings['target'], 'running': self.Running,
+                   'uploading': list(self._active)}
+        if self._queue is not None:
+            metrics.update(self._queue.metrics())
+        return metrics
+
+    def free(self):
+        self.stop()
+        if self._queue is not None:
+            self._queue.free()
+
+
+class ReplicationError(CasysBaseError):
+    def __init__(self, Reason=None):
+        self.__reason = Reason
+
+    def __str__(self):
+        if self.__reason is None:
+            return "Replication failed."
+        else:
+            return str(self.__reason)
+
+
+class ChecksumError(ReplicationError):
+    def __init__(self, Name=None):
+        super().__init__('The replica of {} does not match the segment.'.format(Name))
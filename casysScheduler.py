@@ -0,0 +1,109 @@
+# Copyright 2020 Michael Israel
+#
+# This file is part of Casys.
+#
+# Casys is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Casys is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Casys.  If not, see <http://www.gnu.org/licenses/>.Copyright.
+"""
+Scheduling of Casys. Timers fire on wall-clock boundaries (every hour on the hour, every minute on
+the minute) rather than N seconds after the start, and the scheduler switches the cameras to the
+profiles of the [schedule] section of the settings.
+"""
+from casys_const import SCHEDULE_CHECK_TIME
+from casysabstraction import CasysObject
+import logging
+from time import localtime, time
+
+from gi.repository import GLib
+
+
+def seconds_to_boundary(period, now=None):
+    """
+    Seconds from now to the next multiple of period in local time.
+    """
+    now = time() if now is None else now
+    local = now + localtime(now).tm_gmtoff
+    return period - local % period
+
+
+class CasysAlignedTimer(CasysObject):
+    """
+    Calling callback(*args) on every wall-clock multiple of period, for as long as it returns True.
+    Each firing re-arms from the clock, so the timer does not drift.
+    """
+    def __init__(self, period, callback, *args):
+        super().__init__()
+        self._logger = logging.getLogger('CasysAlignedTimer')
+        self.Period = period
+        self._callback = callback
+        self._args = args
+        self._source = None
+        self._arm()
+
+    def _arm(self):
+        delay = seconds_to_boundary(self.Period)
+        self._logger.debug('Firing {} in {:.1f} seconds.'.format(
+            getattr(self._callback, '__qualname__', self._callback), delay))
+        self._source = GLib.timeout_add(max(int(delay * 1000), 1), self._fire)
+
+    def _fire(self):
+        self._source = None
+        try:
+            again = self._callback(*self._args)
+        except Exception:
+            # A failure must not stop e.g. the fragmentation for good.
+            self._logger.exception('The timer callback failed.')
+            again = True
+        if again:
+            self._arm()
+        return False
+
+    def cancel(self):
+        if self._source is not None:
+            GLib.source_remove(self._source)
+            self._source = None
+
+    def free(self):
+        self.cancel()
+
+
+class CasysScheduler(CasysObject):
+    """
+    Checking the schedule every minute. The new settings of a camera are applied when its next
+    segment starts; those which need no renegotiation (recording on/off, bitrate, display) at once.
+    """
+    def __init__(self, control, config):
+        super().__init__()
+        self._logger = logging.getLogger('CasysScheduler')
+        self._control = control
+        self._config = config
+        self._profiles = {}
+        self._timer = None
+
+    def start(self):
+        self._logger.info('Starting the scheduler.')
+        self.check()
+        self._timer = CasysAlignedTimer(SCHEDULE_CHECK_TIME, self.check)
+
+    def check(self):
+        for device in self._control:
+            profile = self._config.profile(device.DeviceName)
+            if self._profiles.get(device.DeviceName, None) != profile:
+                self._logger.info('Switching {} to profile {}.'.format(device.DeviceName, profile or 'default'))
+                self._profiles[device.DeviceName] = profile
+                self._control.reschedule(device.DeviceName)
+        return True
+
+    def free(self):
+        if self._timer is not None:
+            self._timer.free()
@@ -0,0 +1,428 @@
+# Copyright 2020 Michael Israel
+#
+# This file is part of Casys.
+#
+# Casys is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Casys is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Casys.  If not, see <http://www.gnu.org/licenses/>.Copyright.
+"""
+Control server of Casys. An asyncio loop runs in its own thread next to the GLib main loop and
+serves requests over a Unix socket (one JSON object per line) and over local HTTP
+(/<operation>[/<device>]?<arguments> with the token, operations changing the state by POST).
+The operations themselves run on the GLib main loop, the long ones (encoding, copying) in a pool
+of worker threads.
+"""
+from casysabstraction import CasysObject, CasysBaseError
+from casysControl import snapshot_to_png
+from casysThumbnails import timeline, read_thumbnail
+import casysProfiler
+import asyncio
+import base64
+import concurrent.futures
+import hmac
+import json
+import logging
+import os
+import shutil
+import threading
+from time import localtime, mktime, strftime, strptime
+from urllib.parse import parse_qsl, urlsplit, unquote
+
+from gi.repository import GLib
+
+# Operations changing the state of Casys (or writing files).
+STATE_OPERATIONS = ('record', 'stop', 'fragment', 'snapshot', 'export')
+# Addresses listening on all the interfaces, where the Host of the requests is not checked.
+WILDCARD_ADDRESSES = ('', '0.0.0.0', '::')
+LOOPBACK_ADDRESSES = ('127.0.0.1', '::1')
+
+
+class CasysControlServer(CasysObject):
+    def __init__(self, control, storage, settings, replicator=None, extension=''):
+        super().__init__()
+        self._logger = logging.getLogger('CasysControlServer')
+        self._control = control
+        self._storage = storage
+        self._settings = settings
+        self._replicator = replicator
+        # Of the segments, the storage also holds snapshots and thumbnails.
+        self._extension = extension
+        self._workers = concurrent.futures.ThreadPoolExecutor(max_workers=settings['workers'])
+        self._loop = None
+        self._thread = None
+        self._operations = {
+            'devices': self._op_devices,
+            'record': self._op_record,
+            'stop': self._op_stop,
+            'fragment': self._op_fragment,
+            'snapshot': self._op_snapshot,
+            'export': self._op_export,
+            'metrics': self._op_metrics,
+            'storage': self._op_storage,
+            'profile': self._op_profile,
+            'timeline': self._op_timeline,
+            'thumbnail': self._op_thumbnail,
+            'replication': self._op_replication,
+            }
+
+    def start(self):
+        self._logger.info('Starting the control server.')
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name='CasysControlServer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        self._workers.shutdown(wait=False)
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self._serve())
+            self._loop.run_forever()
+        except Exception:
+            self._logger.exception('The control server stopped.')
+        finally:
+            self._loop.close()
+
+    async def _serve(self):
+        socket_path = self._settings['socket']
+        if socket_path:
+            try:
+                os.unlink(socket_path)
+            except FileNotFoundError:
+                pass
+            await asyncio.start_unix_server(self._handle_socket, path=socket_path)
+            os.chmod(socket_path, 0o600)
+            self._logger.info('Listening on {}.'.format(socket_path))
+        if self._settings['http_port']:
+            await asyncio.start_server(self._handle_http,
+                                       host=self._settings['http_address'],
+                                       port=self._settings['http_port'])
+            self._logger.info('Listening on http://{}:{}.'.format(
+                self._settings['http_address'], self._settings['http_port']))
+            if not self._settings['token']:
+                self._logger.warning('No control token is set: every HTTP request is refused.')
+
+    def _main_loop(self, func, *args):
+        """
+        Running func on the GLib main loop, returning an awaitable of its result.
+        """
+        future = concurrent.futures.Future()
+
+        def call():
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = func(*args)
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    if isinstance(result, concurrent.futures.Future):
+                        # Answered later, e.g. by a worker process.
+                        result.add_done_callback(lambda done: self._chain(done, future))
+                    else:
+                        future.set_result(result)
+            return False
+
+        GLib.idle_add(call)
+        return asyncio.wrap_future(future)
+
+    def _chain(self, done, future):
+        try:
+            future.set_result(done.result())
+        except Exception as e:
+            future.set_exception(e)
+
+    def _worker(self, func, *args):
+        return self._loop.run_in_executor(self._workers, func, *args)
+
+    async def dispatch(self, operation, args):
+        try:
+            handler = self._operations[operation]
+        except KeyError:
+            raise UnknownOperationError(operation) from None
+        self._logger.debug('Operation {} ({}).'.format(operation, args))
+        return await handler(args)
+
+    async def _handle_socket(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    result = await self.dispatch(request['op'], request.get('args', {}))
+                    if isinstance(result, bytes):
+                        result = base64.b64encode(result).decode('ascii')
+                    response = {'ok': True, 'result': result}
+                except Exception as e:
+                    response = {'ok': False, 'error': self._describe(e)}
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_http(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            try:
+                target = request_line[1]
+                url = urlsplit(target)
+                parts = [unquote(part) for part in url.path.split('/') if part]
+                args = dict(parse_qsl(url.query))
+                if len(parts) > 1:
+                    args['device'] = parts[1]
+                operation = parts[0] if parts else ''
+                self._authorize(request_line[0], operation, headers)
+                length = int(headers.get('content-length', 0))
+                if length:
+                    args.update(json.loads(await reader.readexactly(length)))
+                status = 200
+                body = {'ok': True, 'result': await self.dispatch(operation, args)}
+            except HttpRefusedError as e:
+                status, body = e.Status, {'ok': False, 'error': self._describe(e)}
+            except (KeyError, UnknownOperationError) as e:
+                status, body = 404, {'ok': False, 'error': self._describe(e)}
+            except (IndexError, ValueError, TypeError, CasysBaseError) as e:
+                status, body = 400, {'ok': False, 'error': self._describe(e)}
+            except Exception as e:
+                self._logger.exception('Failed to serve an HTTP request.')
+                status, body = 500, {'ok': False, 'error': self._describe(e)}
+
+            if status == 200 and isinstance(body['result'], bytes):
+                # Images (e.g. thumbnails) are sent as they are.
+                payload, content_type = body['result'], 'image/jpeg'
+            else:
+                payload, content_type = json.dumps(body).encode(), 'application/json'
+            writer.write('HTTP/1.0 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n'.format(
+                status, 'OK' if status == 200 else 'Error', content_type, len(payload)).encode('latin-1'))
+            writer.write(payload)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def _authorize(self, method, operation, headers):
+        """
+        The HTTP interface is reachable by any local user and, through a browser, by web pages
+        (cross-site requests, DNS rebinding), unlike the Unix socket. Every request needs the token
+        and the address listened on as its Host, and those changing the state a POST.
+        """
+        token = self._settings['token']
+        if not token:
+            raise HttpRefusedError(403, 'The HTTP interface needs a control token.')
+        address = self._settings['http_address'].lower()
+        if address not in WILDCARD_ADDRESSES:
+            hosts = (address, 'localhost') if address in LOOPBACK_ADDRESSES else (address,)
+            if urlsplit('//' + headers.get('host', '')).hostname not in hosts:
+                raise HttpRefusedError(403, 'The requests must be sent to {}.'.format(address))
+        if not hmac.compare_digest(headers.get('authorization', '').encode('latin-1'),
+                                   ('Bearer ' + token).encode('utf-8')):
+            raise HttpRefusedError(401, 'A valid token is needed.')
+        if operation in STATE_OPERATIONS and method.upper() != 'POST':
+            raise HttpRefusedError(405, 'The {} operation needs a POST.'.format(operation))
+
+    def _arg(self, args, name):
+        try:
+            return args[name]
+        except KeyError:
+            raise MissingArgumentError(name) from None
+
+    def _describe(self, error):
+        if isinstance(error, KeyError):
+            return 'Unknown device {}.'.format(error.args[0] if error.args else '')
+        return str(error) or type(error).__name__
+
+    def _device_name(self, device):
+        """
+        The name of a device given by its name or its path (e.g. /dev/video0), as its files are
+        named. A device no longer present is only known by name.
+        """
+        try:
+            return self._control[device].DeviceName
+        except KeyError:
+            if os.sep in str(device):
+                raise
+            return device
+
+    async def _op_devices(self, args):
+        return await self._main_loop(lambda: [dev.Metrics() for dev in self._control])
+
+    async def _op_record(self, args):
+        await self._main_loop(self._control.record, self._arg(args, 'device'))
+        return True
+
+    async def _op_stop(self, args):
+        await self._main_loop(self._control.stop_record, self._arg(args, 'device'))
+        return True
+
+    async def _op_fragment(self, args):
+        await self._main_loop(self._control.Fragment, args.get('device'))
+        return True
+
+    async def _op_snapshot(self, args):
+        device = await self._main_loop(self._device_name, self._arg(args, 'device'))
+        sample = await self._main_loop(lambda: self._control[device].Snapshot())
+        if isinstance(sample, bytes):
+            # Already encoded by a worker process.
+            png = sample
+        else:
+            png = await self._worker(snapshot_to_png, sample)
+        basename = '{} snapshot {}.png'.format(device, strftime("%Y-%m-%d-%H-%M-%S", localtime()))
+        filename = await self._main_loop(self._storage.allocate, basename)
+        await self._worker(self._write, filename, png)
+        await self._main_loop(self._storage.register, filename)
+        return filename
+
+    def _write(self, filename, data):
+        with open(filename, 'wb') as output:
+            output.write(data)
+
+    async def _op_export(self, args):
+        """
+        Copying the segments of a device recorded between start and end (seconds since the
+        epoch) to the target directory.
+        """
+        device = await self._main_loop(self._device_name, self._arg(args, 'device'))
+        start = float(args.get('start', 0))
+        end = float(args.get('end', mktime(localtime())))
+        target = self._export_path(args.get('target', ''))
+        segments = await self._main_loop(self._storage.find, device)
+        selected = [segment for segment in segments
+                    if segment.endswith(self._extension) and self._overlaps(segment, start, end)]
+        return await self._worker(self._copy, selected, target)
+
+    def _export_path(self, target):
+        """
+        The export directory of a target, which must be under the export path.
+        """
+        base = os.path.realpath(self._settings['export_path'])
+        path = os.path.realpath(os.path.join(base, target))
+        if path != base and not path.startswith(base + os.sep):
+            raise ExportPathError(target)
+        return path
+
+    def _overlaps(self, segment, start, end):
+        try:
+            segment_end = os.stat(segment).st_mtime
+            segment_start = mktime(strptime(os.path.basename(segment).split(' ')[1][:13], "%Y-%m-%d-%H"))
+        except (OSError, IndexError, ValueError):
+            return False
+        return segment_start <= end and segment_end >= start
+
+    def _copy(self, segments, target):
+        os.makedirs(target, exist_ok=True)
+        copied = []
+        for segment in segments:
+            self._logger.info('Exporting {} to {}.'.format(segment, target))
+            copied.append(shutil.copy2(segment, target))
+        return copied
+
+    async def _op_metrics(self, args):
+        return await self._main_loop(lambda: {'devices': self._control.metrics(),
+                                              'storage': self._storage.metrics()})
+
+    async def _op_storage(self, args):
+        return await self._main_loop(self._storage.metrics)
+
+    async def _op_profile(self, args):
+        profiler = casysProfiler.get()
+        if profiler is None:
+            raise ProfilerDisabledError()
+        return await self._main_loop(profiler.report)
+
+    async def _op_timeline(self, args):
+        """
+        The thumbnails of a device between start and end (seconds since the epoch), at most one
+        every step seconds.
+        """
+        device = await self._main_loop(self._device_name, self._arg(args, 'device'))
+        end = float(args.get('end', mktime(localtime())))
+        start = float(args.get('start', end - 24 * 3600))
+        step = float(args.get('step', 0))
+        files = await self._main_loop(self._storage.find, device)
+        return await self._worker(timeline, files, start, end, step)
+
+    async def _op_thumbnail(self, args):
+        """
+        The JPEG of the thumbnail of a device closest to a time (seconds since the epoch).
+        """
+        device = await self._main_loop(self._device_name, self._arg(args, 'device'))
+        files = await self._main_loop(self._storage.find, device)
+        return await self._worker(read_thumbnail, files, float(self._arg(args, 'time')))
+
+    async def _op_replication(self, args):
+        if self._replicator is None:
+            raise ReplicationDisabledError()
+        return await self._worker(self._replicator.metrics)
+
+    def free(self):
+        self.stop()
+
+
+class UnknownOperationError(CasysBaseError):
+    def __init__(self, Name=None):
+        self.__name = Name
+
+    def __str__(self):
+        return "Unknown operation {}.".format(self.__name)
+
+
+class MissingArgumentError(CasysBaseError):
+    def __init__(self, Name=None):
+        self.__name = Name
+
+    def __str__(self):
+        return "Missing argument {}.".format(self.__name)
+
+
+class ProfilerDisabledError(CasysBaseError):
+    def __str__(self):
+        return "The profiler is not enabled."
+
+
+class ReplicationDisabledError(CasysBaseError):
+    def __str__(self):
+        return "The replication is not enabled."
+
+
+class HttpRefusedError(CasysBaseError):
+    def __init__(self, Status, Reason=None):
+        self.Status = Status
+        self.__reason = Reason
+
+    def __str__(self):
+        if self.__reason is None:
+            return "The request is refused."
+        else:
+            return self.__reason
+
+
+class ExportPathError(CasysBaseError):
+    def __init__(self, Target=None):
+        self.__target = Target
+
+    def __str__(self):
+        return "The export target {} is not under the export path.".format(self.__target)
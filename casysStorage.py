@@ -0,0 +1,385 @@
+# Copyright 2020 Michael Israel
+#
+# This file is part of Casys.
+#
+# Casys is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Casys is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Casys.  If not, see <http://www.gnu.org/licenses/>.Copyright.
+"""
+Storage pool of Casys. Video segments are spread over several volumes (mount points), each new
+segment being placed on the volume with the most free space relative to its recent write load.
+"""
+from casys_const import VIDEO_STORAGE_PATHS, VIDEO_MIN_FREE_SPACE, STORAGE_RETRY_TIME, \
+    STORAGE_THROUGHPUT_WEIGHT, STORAGE_SEGMENT_RATE
+from casysabstraction import CasysObject, CasysBaseError
+import logging
+import os
+from tempfile import TemporaryFile
+from time import time
+
+
+class CasysVolume(CasysObject):
+    def __init__(self, mount_point):
+        super().__init__()
+        self.Path = mount_point
+        self._logger = logging.getLogger('Casys.Volume.' + str(mount_point))
+        self.Enabled = True
+        self.Reason = None
+        self.Throughput = 0.0
+        self._disabled_at = 0
+        self._device = None
+        self._open = {}
+        self._last_poll = time()
+
+    def check(self, create=False):
+        """
+        Making sure the volume exists and is writable by creating a 'dummy' file in it.
+        The directory of the volume is only created at its setup (create), under an existing
+        directory. Later checks make sure it is still on the same device: a disk unmounted leaves
+        its mount point on the root filesystem, which must not be recorded to.
+        """
+        try:
+            device = os.stat(self.Path).st_dev
+        except FileNotFoundError:
+            if not create:
+                raise
+            self._logger.info("Volume directory does not exist. Creating it.")
+            os.mkdir(self.Path, 0o755)
+            device = os.stat(self.Path).st_dev
+        if self._device is None:
+            self._device = device
+        elif device != self._device:
+            raise VolumeChangedError(self.Path)
+
+        self._logger.debug("Attempting to create a 'dummy' file in the volume.")
+        try:
+            TmpFile = TemporaryFile(dir=self.Path)
+            TmpFile.close()
+        except PermissionError:
+            self._logger.info("No write permission for the volume. Attempting to fix, and reruning the check.")
+            os.chmod(self.Path, 0o755)
+            TmpFile = TemporaryFile(dir=self.Path)
+            TmpFile.close()
+
+    def free(self):
+        pass
+
+    def free_space(self):
+        stat = os.statvfs(self.Path)
+        return stat.f_bavail * stat.f_frsize
+
+    def disable(self, reason):
+        if self.Enabled:
+            self._logger.error("Taking volume out of rotation: {}".format(reason))
+        self.Enabled = False
+        self.Reason = str(reason)
+        self._disabled_at = time()
+
+    def enable(self):
+        if not self.Enabled:
+            self._logger.info("Returning volume to rotation.")
+        self.Enabled = True
+        self.Reason = None
+
+    def retry_due(self):
+        return not self.Enabled and time() - self._disabled_at >= STORAGE_RETRY_TIME
+
+    def open_segment(self, filename):
+        self._open[filename] = 0
+
+    def close_segment(self, filename):
+        self._open.pop(filename, None)
+
+    def recording(self, filename):
+        return filename in self._open
+
+    def poll(self):
+        """
+        Updating the recent write throughput (bytes/s, exponentially averaged) from the growth of
+        the segments currently being written to this volume.
+        """
+        now = time()
+        elapsed = now - self._last_poll
+        self._last_poll = now
+        written = 0
+        for filename, last_size in self._open.items():
+            try:
+                size = os.stat(filename).st_size
+            except OSError:
+                continue
+            written += max(size - last_size, 0)
+            self._open[filename] = size
+        if elapsed > 0:
+            self.Throughput = STORAGE_THROUGHPUT_WEIGHT * (written / elapsed) + \
+                (1 - STORAGE_THROUGHPUT_WEIGHT) * self.Throughput
+
+    def load(self):
+        """
+        The expected write load (bytes/s). Freshly opened segments have not been polled yet, so
+        each of them counts at least for STORAGE_SEGMENT_RATE.
+        """
+        return max(self.Throughput, len(self._open) * STORAGE_SEGMENT_RATE)
+
+    def owns(self, filename):
+        return os.path.dirname(os.path.abspath(filename)) == os.path.abspath(self.Path)
+
+    def files(self):
+        for entry in os.listdir(self.Path):
+            yield os.path.join(self.Path, entry)
+
+
+class CasysStoragePool(CasysObject):
+    def __init__(self, paths=VIDEO_STORAGE_PATHS):
+        super().__init__()
+        self._logger = logging.getLogger('CasysStoragePool')
+        self._logger.debug('Initializing a storage pool of: {}'.format(paths))
+        self.__volumes = [CasysVolume(p) for p in paths]
+        self.__catalog = {}
+        self.__listeners = []
+
+    def __iter__(self):
+        return iter(self.__volumes)
+
+    def set_paths(self, paths):
+        """
+        Changing the volumes of the pool. Segments being written to a removed volume are left
+        to finish there. Its files stay in the catalog (found, exported, replicated) until they
+        expire, only new segments are no longer placed on it.
+        """
+        current = [volume.Path for volume in self.__volumes]
+        for volume in [volume for volume in self.__volumes if volume.Path not in paths]:
+            self._logger.info('Removing volume {} from the pool.'.format(volume.Path))
+            self.__volumes.remove(volume)
+
+        for path in paths:
+            if path in current:
+                continue
+            self._logger.info('Adding volume {} to the pool.'.format(path))
+            volume = CasysVolume(path)
+            self.__volumes.append(volume)
+            try:
+                volume.check(create=True)
+            except (OSError, VolumeChangedError) as e:
+                volume.disable(e)
+            else:
+                self._scan(volume)
+
+    def __len__(self):
+        return len(self.__volumes)
+
+    def check(self):
+        """
+        Checking all the volumes and building the catalog of the already recorded files.
+        Failing volumes are taken out of rotation, only if none is left an error is raised.
+        """
+        for volume in self.__volumes:
+            try:
+                volume.check(create=True)
+                if volume.free_space() < VIDEO_MIN_FREE_SPACE:
+                    volume.disable('volume is full')
+                    continue
+            except (OSError, VolumeChangedError) as e:
+                volume.disable(e)
+                continue
+            volume.enable()
+            self._scan(volume)
+
+        if not any(volume.Enabled for volume in self.__volumes):
+            raise NoVolumeError()
+
+    def _scan(self, volume):
+        try:
+            for filename in volume.files():
+                previous = self.__catalog.get(filename)
+                if previous is not None and previous.recording(filename):
+                    # Still being written through the volume it was placed on (removed and re-added).
+                    continue
+                self.__catalog[filename] = volume
+        except OSError:
+            self._logger.exception("Failed to scan volume {}.".format(volume.Path))
+
+    def refresh(self):
+        """
+        Periodic update of the volumes' throughput and free space. A full volume is taken out of
+        rotation, a disabled one is re-checked after STORAGE_RETRY_TIME.
+        """
+        for volume in self.__volumes:
+            if volume.Enabled:
+                volume.poll()
+                try:
+                    if volume.free_space() < VIDEO_MIN_FREE_SPACE:
+                        volume.disable('volume is full')
+                except OSError as e:
+                    volume.disable(e)
+            elif volume.retry_due():
+                try:
+                    volume.check()
+                    if volume.free_space() >= VIDEO_MIN_FREE_SPACE:
+                        volume.enable()
+                        self._scan(volume)
+                    else:
+                        volume.disable('volume is full')
+                except (OSError, VolumeChangedError) as e:
+                    volume.disable(e)
+        return True
+
+    def allocate(self, basename):
+        """
+        Returning a full path for a new segment. The volume chosen is the one with the least
+        expected load per free byte, so a volume with twice the free space takes twice the load.
+        """
+        if os.sep in basename or basename in ('', os.curdir, os.pardir):
+            # os.path.join() would place it outside of the volumes.
+            raise InvalidFilenameError(basename)
+        candidates = []
+        for volume in self.__volumes:
+            if not volume.Enabled:
+                continue
+            try:
+                space = volume.free_space()
+            except OSError as e:
+                volume.disable(e)
+                continue
+            if space < VIDEO_MIN_FREE_SPACE:
+                volume.disable('volume is full')
+                continue
+            candidates.append(((volume.load() + 1) / space, volume))
+
+        if not candidates:
+            raise NoVolumeError()
+
+        volume = min(candidates, key=lambda candidate: candidate[0])[1]
+        filename = os.path.join(volume.Path, basename)
+        self._logger.debug('Placing {} on {}.'.format(basename, volume.Path))
+        return filename
+
+    def volume_of(self, filename):
+        try:
+            return self.__catalog[filename]
+        except KeyError:
+            for volume in self.__volumes:
+                if volume.owns(filename):
+                    return volume
+        return None
+
+    def exists(self, basename):
+        return any(os.path.exists(os.path.join(volume.Path, basename)) for volume in self.__volumes)
+
+    def register(self, filename, recording=False):
+        """
+        Adding a file to the catalog. Files being recorded count for their volume's throughput.
+        """
+        volume = self.volume_of(filename)
+        if volume is None:
+            self._logger.warning('{} does not belong to any volume.'.format(filename))
+            return
+        self.__catalog[filename] = volume
+        if recording:
+            volume.open_segment(filename)
+
+    def connect(self, callback):
+        """
+        Registering callback(filename), called when a segment is complete.
+        """
+        self.__listeners.append(callback)
+
+    def segment_closed(self, filename):
+        volume = self.volume_of(filename)
+        if volume is not None:
+            volume.poll()
+            volume.close_segment(filename)
+        for callback in self.__listeners:
+            try:
+                callback(filename)
+            except Exception:
+                self._logger.exception('A listener failed on {}.'.format(filename))
+
+    def volume_failed(self, filename, reason):
+        volume = self.volume_of(filename)
+        if volume is not None:
+            volume.close_segment(filename)
+            volume.disable(reason)
+
+    def remove(self, filename):
+        os.remove(filename)
+        self.__catalog.pop(filename, None)
+
+    def forget(self, filename):
+        self.__catalog.pop(filename, None)
+
+    def files(self):
+        """
+        All the cataloged files over all volumes.
+        """
+        return list(self.__catalog)
+
+    def segments(self, extension):
+        """
+        The cataloged segments over all volumes which are complete (not being recorded).
+        """
+        return [filename for filename, volume in self.__catalog.items()
+                if filename.endswith(extension) and not volume.recording(filename)]
+
+    def find(self, device_name):
+        """
+        The cataloged segments of a device over all volumes, sorted by modification time.
+        """
+        prefix = device_name + ' '
+        found = []
+        for filename in self.__catalog:
+            if os.path.basename(filename).startswith(prefix):
+                try:
+                    found.append((os.stat(filename).st_mtime, filename))
+                except OSError:
+                    continue
+        return [filename for _, filename in sorted(found)]
+
+    def metrics(self):
+        volumes = []
+        for volume in self.__volumes:
+            try:
+                space = volume.free_space()
+            except OSError:
+                space = None
+            volumes.append({
+                'path': volume.Path,
+                'enabled': volume.Enabled,
+                'reason': volume.Reason,
+                'free': space,
+                'throughput': volume.Throughput,
+                'segments': sum(1 for v in self.__catalog.values() if v is volume),
+                })
+        return volumes
+
+    def free(self):
+        pass
+
+
+class NoVolumeError(CasysBaseError):
+    def __str__(self):
+        return "No storage volume is available for recording."
+
+
+class InvalidFilenameError(CasysBaseError):
+    def __init__(self, Name=None):
+        self.__name = Name
+
+    def __str__(self):
+        return "{} is not a valid file name for a volume.".format(self.__name)
+
+
+class VolumeChangedError(CasysBaseError):
+    def __init__(self, Path=None):
+        self.__path = Path
+
+    def __str__(self):
+        return "{} is no longer on the device it was set up on (unmounted?).".format(self.__path)
@@ -0,0 +1,558 @@
+# Copyright 2020 Michael Israel
+#
+# This file is part of Casys.
+#
+# Casys is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Casys is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Casys.  If not, see <http://www.gnu.org/licenses/>.Copyright.
+"""
+Multi-process mode of Casys. Each device runs its pipeline in its own worker process, optionally
+pinned to a set of CPUs, with its own GLib main loop. The supervisor (in the main process) forwards
+the workers' logs, collects their health reports, sends them commands and restarts a single worker
+when it dies or stops reporting. It offers the same operations as CasysControl. The segments of all
+the workers are placed by the storage pool of the supervisor.
+"""
+from casysabstraction import CasysObject, CasysBaseError
+from casysControl import CasysDevice, is_capture_device, snapshot_to_png
+from casysConfig import CasysConfig
+from casysRecovery import CasysSegmentFinalizer
+import casysProfiler
+import concurrent.futures
+import itertools
+import logging
+import multiprocessing
+import os
+from glob import iglob
+from logging.handlers import QueueHandler, QueueListener
+from time import monotonic
+
+from gi.repository import GLib
+
+# The storage pool methods a worker may call.
+REMOTE_STORAGE_METHODS = ('exists', 'allocate', 'register', 'segment_closed', 'volume_failed')
+
+
+def worker_main(device_path, settings_file, xid, cpus, log_level, log_queue, connection):
+    """
+    Entry point of a worker process.
+    """
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+
+    logRoot = logging.getLogger()
+    logRoot.handlers = []
+    logRoot.setLevel(log_level)
+    logRoot.addHandler(QueueHandler(log_queue))
+
+    try:
+        CasysWorkerProcess(device_path, settings_file, xid, connection).run()
+    except Exception:
+        logging.getLogger('CasysWorker ' + device_path).critical('Uncaught exception', exc_info=True)
+        raise
+
+
+class CasysRemoteStorage(CasysObject):
+    """
+    The storage pool of the supervisor, as seen by a worker. The supervisor sees the load and the
+    failed volumes of all the cameras; the calls are forwarded to it over the pipe.
+    """
+    def __init__(self, connection, on_deferred):
+        super().__init__()
+        self._connection = connection
+        self._on_deferred = on_deferred
+        self._ids = itertools.count()
+        self.Deferred = []
+
+    def _call(self, method, *args):
+        """
+        Calling a method of the supervisor's pool and waiting for its result. Commands received
+        meanwhile are deferred.
+        """
+        identifier = next(self._ids)
+        self._connection.send(('storage', identifier, method, args))
+        while True:
+            message = self._connection.recv()
+            if message[0] == 'storage' and message[1] == identifier:
+                _, _, ok, result = message
+                if not ok:
+                    raise result
+                return result
+            self.Deferred.append(message)
+            self._on_deferred()
+
+    def _notify(self, method, *args):
+        self._connection.send(('storage', None, method, args))
+
+    def exists(self, basename):
+        return self._call('exists', basename)
+
+    def allocate(self, basename):
+        return self._call('allocate', basename)
+
+    def register(self, filename, recording=False):
+        self._notify('register', filename, recording)
+
+    def segment_closed(self, filename):
+        self._notify('segment_closed', filename)
+
+    def volume_failed(self, filename, reason):
+        self._notify('volume_failed', filename, str(reason))
+
+    def free(self):
+        pass
+
+
+class CasysWorkerProcess(CasysObject):
+    """
+    The device side of a worker: one CasysDevice, driven by the commands of the supervisor.
+    """
+    def __init__(self, device_path, settings_file, xid, connection):
+        super().__init__()
+        self._logger = logging.getLogger('CasysWorker ' + device_path)
+        self._connection = connection
+        self._config = CasysConfig(settings_file)
+        supervisor = self._config['supervisor']
+        self._health_interval = supervisor['health_interval']
+        if self._config['profiler']['enabled']:
+            casysProfiler.install(self._config['profiler']['threshold'], self._config['profiler']['tracers'])
+
+        self._storage = CasysRemoteStorage(connection, self._on_deferred)
+        self._device = CasysDevice(device_path, self._storage, self._config)
+        self._device.CreatePipeline()
+        if xid is not None:
+            self._device.connectGui(xid)
+        self._device.Start()
+        self._device.Record(True)
+
+        self._config.connect(self._reconfigure)
+        self._commands = {
+            'record': lambda: self._device.Record(True),
+            'stop': lambda: self._device.Record(False),
+            'fragment': self._device.Fragment,
+            'snapshot': lambda: snapshot_to_png(self._device.Snapshot()),
+            'reload': self._config.reload,
+            'reschedule': lambda: self._device.Reconfigure(self._config.camera(self._device.DeviceName),
+                                                           immediate=False),
+            'metrics': self._device.Metrics,
+            }
+
+    def run(self):
+        GLib.timeout_add_seconds(self._health_interval, self._report)
+        GLib.io_add_watch(self._connection.fileno(), GLib.PRIORITY_DEFAULT,
+                          GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self._on_command)
+        self._report()
+        self._loop = GLib.MainLoop()
+        self._loop.run()
+        self._device.free()
+
+    def _reconfigure(self, config, changes):
+        if 'camera' in changes or 'camera:' + self._device.DeviceName in changes:
+            self._device.Reconfigure(config.camera(self._device.DeviceName))
+
+    def _report(self):
+        try:
+            self._connection.send(('health', self._device.Metrics()))
+        except (OSError, EOFError):
+            self._logger.critical('Lost the supervisor. Exiting.')
+            self._loop.quit()
+            return False
+        return True
+
+    def _on_command(self, fd, condition):
+        if condition & (GLib.IO_HUP | GLib.IO_ERR):
+            self._logger.critical('Lost the supervisor. Exiting.')
+            self._loop.quit()
+            return False
+        try:
+            self._handle(self._connection.recv())
+        except (OSError, EOFError):
+            self._loop.quit()
+            return False
+        return True
+
+    def _on_deferred(self):
+        GLib.idle_add(self._drain)
+
+    def _drain(self):
+        """
+        Handling the commands received while waiting for the storage of the supervisor.
+        """
+        while self._storage.Deferred:
+            try:
+                self._handle(self._storage.Deferred.pop(0))
+            except (OSError, EOFError):
+                self._loop.quit()
+                break
+        return False
+
+    def _handle(self, message):
+        _, identifier, command = message
+        self._logger.debug('Command {}.'.format(command))
+        try:
+            reply = ('reply', identifier, True, self._commands[command]())
+        except Exception as e:
+            reply = ('reply', identifier, False, str(e) or type(e).__name__)
+        self._connection.send(reply)
+
+    def free(self):
+        self._device.free()
+
+
+class CasysWorker(CasysObject):
+    """
+    The supervisor side of a worker.
+    """
+    def __init__(self, device_path, cpus):
+        super().__init__()
+        self.DevicePath = device_path
+        self.DeviceName = os.path.basename(device_path)
+        self._logger = logging.getLogger('CasysSupervisor.' + self.DeviceName)
+        self.Cpus = cpus
+        self.Restarts = 0
+        self.Health = {}
+        self.LastHealth = None
+        self.StartedAt = None
+        self.RestartDelay = 0
+        self.RestartAt = None
+        self.CurrentFile = None
+        self._process = None
+        self._connection = None
+        self._watch = None
+        self._pending = {}
+        self._ids = itertools.count()
+
+    @property
+    def Alive(self):
+        return self._process is not None and self._process.is_alive()
+
+    def start(self, context, settings_file, xid, log_level, log_queue, on_message):
+        self._logger.info('Starting a worker (cpus: {}).'.format(self.Cpus or 'all'))
+        self._connection, child = context.Pipe()
+        self._process = context.Process(target=worker_main, name='casys-' + self.DeviceName,
+                                        args=(self.DevicePath, settings_file, xid, self.Cpus,
+                                              log_level, log_queue, child))
+        self._process.daemon = True
+        self._process.start()
+        child.close()
+        self.StartedAt = monotonic()
+        self.LastHealth = monotonic()
+        self.RestartAt = None
+        self._watch = GLib.io_add_watch(self._connection.fileno(), GLib.PRIORITY_DEFAULT,
+                                        GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, on_message, self)
+
+    def unwatch(self):
+        """
+        Called when the watch of the connection was removed by returning False.
+        """
+        self._watch = None
+
+    def stop(self):
+        if self._watch is not None:
+            GLib.source_remove(self._watch)
+            self._watch = None
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join(1)
+            if self._process.is_alive():
+                self._process.kill()
+                self._process.join()
+            self._process = None
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        for future in self._pending.values():
+            future.set_exception(WorkerError(self.DeviceName, 'the worker stopped'))
+        self._pending = {}
+
+    def send(self, command):
+        """
+        Sending a command. Returns a concurrent.futures.Future of its result.
+        """
+        future = concurrent.futures.Future()
+        future.set_running_or_notify_cancel()
+        if not self.Alive:
+            future.set_exception(WorkerError(self.DeviceName, 'not running'))
+            return future
+        identifier = next(self._ids)
+        self._pending[identifier] = future
+        try:
+            self._connection.send(('command', identifier, command))
+        except OSError as e:
+            del self._pending[identifier]
+            future.set_exception(WorkerError(self.DeviceName, e))
+        return future
+
+    def receive(self):
+        message = self._connection.recv()
+        if message[0] == 'health':
+            self.Health = message[1]
+            self.LastHealth = monotonic()
+        elif message[0] == 'reply':
+            _, identifier, ok, result = message
+            future = self._pending.pop(identifier, None)
+            if future is None:
+                return message
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(WorkerError(self.DeviceName, result))
+        return message
+
+    def reply_storage(self, identifier, ok, result):
+        try:
+            self._connection.send(('storage', identifier, ok, result))
+        except OSError:
+            self._logger.warning('Failed to answer a storage request.', exc_info=True)
+
+    def set_cpus(self, cpus):
+        self.Cpus = cpus
+        if self.Alive:
+            os.sched_setaffinity(self._process.pid, cpus or range(os.cpu_count()))
+
+    def Snapshot(self):
+        return self.send('snapshot')
+
+    def Metrics(self):
+        metrics = dict(self.Health)
+        metrics.update({
+            'name': self.DeviceName,
+            'path': self.DevicePath,
+            'pid': self._process.pid if self._process is not None else None,
+            'alive': self.Alive,
+            'cpus': list(self.Cpus),
+            'restarts': self.Restarts,
+            })
+        return metrics
+
+    def free(self):
+        self.stop()
+
+
+class CasysSupervisor(CasysObject):
+    def __init__(self, storage, config):
+        super().__init__()
+        self._logger = logging.getLogger('CasysSupervisor')
+        self._storage = storage
+        self._config = config
+        self._context = multiprocessing.get_context('spawn')
+        self._log_queue = self._context.Queue(-1)
+        self._log_listener = QueueListener(self._log_queue, *logging.getLogger().handlers,
+                                           respect_handler_level=True)
+        self._workers = {}
+        self._xids = {}
+        self._started = False
+        self._finalizer = CasysSegmentFinalizer()
+        self.update()
+
+    def update(self):
+        self._logger.debug('Finding new available camera devices.')
+        video_devices = list(iglob(self._config['devices']['pattern']))
+        for name, worker in list(self._workers.items()):
+            if worker.DevicePath not in video_devices:
+                self._logger.info('Removing {}. (no longer matching the devices pattern)'.format(worker.DevicePath))
+                del self._workers[name]
+                self._xids.pop(name, None)
+                worker.stop()
+                if worker.CurrentFile is not None:
+                    self._close_segment(worker.CurrentFile)
+                    worker.CurrentFile = None
+        for video_device in video_devices:
+            name = os.path.basename(video_device)
+            if name in self._workers:
+                continue
+            if not is_capture_device(video_device, self._logger):
+                continue
+            self._logger.info('New video capturing device: {}.'.format(video_device))
+            self._workers[name] = CasysWorker(video_device, self._config.camera(name)['cpus'])
+            if self._started:
+                self._start(self._workers[name])
+        self._logger.debug("Currently {} detected camera devices.".format(len(self._workers)))
+
+    def __iter__(self):
+        return iter(list(self._workers.values()))
+
+    def __len__(self):
+        return len(self._workers)
+
+    def __getitem__(self, key):
+        if type(key) is int:
+            return list(self._workers.values())[key]
+        try:
+            return self._workers[key]
+        except KeyError:
+            for worker in self._workers.values():
+                if worker.DevicePath == key:
+                    return worker
+            raise
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except (KeyError, IndexError):
+            return False
+        return True
+
+    def record(self, device=None):
+        if device is None:
+            return
+        return self[device].send('record')
+
+    def stop_record(self, device):
+        return self[device].send('stop')
+
+    def reschedule(self, device):
+        return self[device].send('reschedule')
+
+    def connect(self, xid, device=None):
+        """
+        Starting the workers, displaying in the given windows. The windows belong to this process,
+        the workers draw in them through their XIDs.
+        """
+        for worker, window in zip(self._workers.values(), xid):
+            self._xids[worker.DeviceName] = window
+        if not self._started:
+            self.start()
+
+    def start(self):
+        self._logger.info('Starting {} workers.'.format(len(self._workers)))
+        self._started = True
+        self._log_listener.start()
+        for worker in self._workers.values():
+            self._start(worker)
+        GLib.timeout_add_seconds(self._config['supervisor']['health_interval'], self._supervise)
+
+    def _start(self, worker):
+        try:
+            worker.start(self._context, self._config.Filename, self._xids.get(worker.DeviceName),
+                         logging.getLogger().getEffectiveLevel(), self._log_queue, self._on_message)
+        except OSError:
+            self._logger.critical('Failed to start a worker for {}.'.format(worker.DevicePath), exc_info=True)
+            self._schedule_restart(worker)
+
+    def _on_message(self, fd, condition, worker):
+        if condition & (GLib.IO_HUP | GLib.IO_ERR):
+            # The worker is gone, _supervise restarts it.
+            worker.unwatch()
+            return False
+        try:
+            message = worker.receive()
+        except (OSError, EOFError):
+            worker.unwatch()
+            return False
+        if message[0] == 'storage':
+            self._storage_request(worker, *message[1:])
+        return True
+
+    def _storage_request(self, worker, identifier, method, args):
+        """
+        Serving a call of a worker to the storage pool (see CasysRemoteStorage).
+        """
+        try:
+            if method not in REMOTE_STORAGE_METHODS:
+                raise WorkerError(worker.DeviceName, 'unknown storage method {}'.format(method))
+            result = getattr(self._storage, method)(*args)
+            ok = True
+        except Exception as e:
+            result, ok = e, False
+        if method == 'register' and ok and args[1:] == (True,):
+            worker.CurrentFile = args[0]
+        elif method in ('segment_closed', 'volume_failed') and args[0] == worker.CurrentFile:
+            worker.CurrentFile = None
+        if identifier is not None:
+            worker.reply_storage(identifier, ok, result)
+        elif not ok:
+            self._logger.warning('Storage call {} of {} failed: {}'.format(method, worker.DeviceName, result))
+
+    def _supervise(self):
+        settings = self._config['supervisor']
+        now = monotonic()
+        for worker in self._workers.values():
+            if worker.RestartAt is not None:
+                if now >= worker.RestartAt:
+                    worker.Restarts += 1
+                    self._start(worker)
+                continue
+
+            if not worker.Alive:
+                self._logger.error('The worker of {} died.'.format(worker.DeviceName))
+            elif now - worker.LastHealth > 3 * settings['health_interval']:
+                self._logger.error('The worker of {} stopped reporting.'.format(worker.DeviceName))
+            elif worker.Health.get('error'):
+                self._logger.error('The pipeline of {} failed: {}'.format(worker.DeviceName, worker.Health['error']))
+            else:
+                if now - worker.StartedAt > settings['max_restart_delay']:
+                    worker.RestartDelay = 0
+                continue
+            self._schedule_restart(worker)
+        return True
+
+    def _schedule_restart(self, worker):
+        settings = self._config['supervisor']
+        worker.stop()
+        worker.Health = {}
+        if worker.CurrentFile is not None:
+            self._close_segment(worker.CurrentFile)
+            worker.CurrentFile = None
+        worker.RestartDelay = min(max(worker.RestartDelay * 2, settings['restart_delay']),
+                                  settings['max_restart_delay'])
+        worker.RestartAt = monotonic() + worker.RestartDelay
+        self._logger.info('Restarting the worker of {} in {} seconds.'.format(
+            worker.DeviceName, worker.RestartDelay))
+
+    def _close_segment(self, filename):
+        """
+        Repairing the segment a stopped worker was writing (off the main loop), before it counts
+        as complete.
+        """
+        self._finalizer.finalize(filename, lambda filename: GLib.idle_add(self._segment_finalized, filename))
+
+    def _segment_finalized(self, filename):
+        self._storage.segment_closed(filename)
+        return False
+
+    def Fragment(self, device=None):
+        if device:
+            self[device].send('fragment')
+        else:
+            for worker in self._workers.values():
+                worker.send('fragment')
+        return True
+
+    def reconfigure(self, config, changes):
+        for worker in self._workers.values():
+            section = 'camera:' + worker.DeviceName
+            if section in changes or 'camera' in changes:
+                cpus = config.camera(worker.DeviceName)['cpus']
+                if cpus != worker.Cpus:
+                    worker.set_cpus(cpus)
+            if changes - {'supervisor', 'control', 'profiler'}:
+                worker.send('reload')
+        if 'devices' in changes:
+            self.update()
+
+    def metrics(self):
+        return [worker.Metrics() for worker in self._workers.values()]
+
+    def free(self):
+        for worker in self._workers.values():
+            worker.stop()
+        self._finalizer.free()
+        self._log_listener.stop()
+
+
+class WorkerError(CasysBaseError):
+    def __init__(self, Name=None, Reason=None):
+        self.__name = Name
+        self.__reason = Reason
+
+    def __str__(self):
+        return "Worker of {} failed: {}".format(self.__name, self.__reason)
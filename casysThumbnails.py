@@ -0,0 +1,216 @@
+# Copyright 2020 Michael Israel
+#
+# This file is part of Casys.
+#
+# Casys is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Casys is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Casys.  If not, see <http://www.gnu.org/licenses/>.Copyright.
+"""
+Timeline thumbnails of Casys. While recording, each segment gets two files next to it:
+ - '<segment>.thumbs', the JPEG thumbnails appended one after the other.
+ - '<segment>.tidx', an index of fixed-size records (time, offset, length) into the first.
+A scrub bar over a whole day only reads the small index files, and then the thumbnails shown.
+"""
+from casys_const import THUMBNAIL_DATA_EXTENSION, THUMBNAIL_INDEX_EXTENSION
+from casysabstraction import CasysObject, CasysBaseError
+from bisect import bisect_left
+import logging
+import os
+import struct
+import threading
+
+# time (seconds since the epoch), offset, length.
+RECORD = struct.Struct('<dQI')
+
+
+def thumbnail_files(segment):
+    """
+    The data and index files of the thumbnails of a segment.
+    """
+    base = os.path.splitext(segment)[0]
+    return base + THUMBNAIL_DATA_EXTENSION, base + THUMBNAIL_INDEX_EXTENSION
+
+
+class CasysThumbnailWriter(CasysObject):
+    """
+    Appending the thumbnails of a segment. append() is called from the streaming thread,
+    open() and close() from the main loop.
+    """
+    def __init__(self):
+        super().__init__()
+        self._logger = logging.getLogger('CasysThumbnailWriter')
+        self._lock = threading.Lock()
+        self._data = None
+        self._index = None
+        self._offset = 0
+        self.Files = None
+
+    def open(self, segment):
+        files = thumbnail_files(segment)
+        with self._lock:
+            self._close()
+            self._logger.debug('Writing thumbnails to {}.'.format(files[0]))
+            try:
+                self._data = open(files[0], 'ab')
+                self._index = open(files[1], 'ab')
+            except OSError:
+                self._logger.exception('Failed to open the thumbnails of {}.'.format(segment))
+                self._close()
+                return None
+            self._offset = self._data.tell()
+            self.Files = files
+        return files
+
+    def append(self, timestamp, jpeg):
+        with self._lock:
+            if self._data is None:
+                return
+            try:
+                self._data.write(jpeg)
+                # The thumbnail is complete before it is indexed.
+                self._data.flush()
+                self._index.write(RECORD.pack(timestamp, self._offset, len(jpeg)))
+                self._index.flush()
+            except OSError:
+                self._logger.exception('Failed to write a thumbnail. Stopping the thumbnails of this segment.')
+                self._close()
+                return
+            self._offset += len(jpeg)
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        for stream in (self._data, self._index):
+            if stream is not None:
+                try:
+                    stream.close()
+                except OSError:
+                    pass
+        self._data = self._index = None
+        self.Files = None
+
+    def free(self):
+        self.close()
+
+
+class CasysThumbnailIndex():
+    """
+    Reading the thumbnails of a segment. Records left incomplete by a crash are ignored.
+    """
+    def __init__(self, index_file):
+        self.IndexFile = index_file
+        self.DataFile = os.path.splitext(index_file)[0] + THUMBNAIL_DATA_EXTENSION
+        with open(index_file, 'rb') as index:
+            raw = index.read()
+        try:
+            data_size = os.path.getsize(self.DataFile)
+        except OSError:
+            data_size = 0
+        self.Entries = [entry for entry in RECORD.iter_unpack(raw[:len(raw) - len(raw) % RECORD.size])
+                        if entry[1] + entry[2] <= data_size]
+        self._times = [entry[0] for entry in self.Entries]
+
+    @property
+    def Start(self):
+        return self._times[0] if self._times else None
+
+    @property
+    def End(self):
+        return self._times[-1] if self._times else None
+
+    def between(self, start, end):
+        """
+        The entries (time, offset, length) from start up to end.
+        """
+        first = bisect_left(self._times, start)
+        last = bisect_left(self._times, end, first)
+        if last < len(self._times) and self._times[last] == end:
+            last += 1
+        return self.Entries[first:last]
+
+    def closest(self, timestamp):
+        """
+        The entry closest to timestamp, None without entries.
+        """
+        position = bisect_left(self._times, timestamp)
+        candidates = self.Entries[max(position - 1, 0):position + 1]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda entry: abs(entry[0] - timestamp))
+
+    def read(self, entry):
+        _, offset, length = entry
+        with open(self.DataFile, 'rb') as data:
+            data.seek(offset)
+            return data.read(length)
+
+
+def timeline(files, start, end, step=0):
+    """
+    The thumbnails between start and end, at most one every step seconds, as a list of
+    {'time', 'file', 'offset', 'length'}. files are the files of a device in the order they were
+    written (see CasysStoragePool.find()); only their index files are read.
+    """
+    logger = logging.getLogger('CasysThumbnails')
+    result = []
+    last = None
+    for filename in files:
+        if not filename.endswith(THUMBNAIL_INDEX_EXTENSION):
+            continue
+        try:
+            # Index files are written up to the end of their segment.
+            if os.stat(filename).st_mtime < start:
+                continue
+            index = CasysThumbnailIndex(filename)
+        except OSError:
+            logger.warning('Failed to read the thumbnails index {}.'.format(filename), exc_info=True)
+            continue
+        for timestamp, offset, length in index.between(start, end):
+            if last is not None and timestamp < last + step:
+                continue
+            last = timestamp
+            result.append({'time': timestamp, 'file': index.DataFile, 'offset': offset, 'length': length})
+    result.sort(key=lambda thumbnail: thumbnail['time'])
+    return result
+
+
+def read_thumbnail(files, timestamp):
+    """
+    The JPEG of the thumbnail closest to timestamp, among the files of a device.
+    """
+    best = None
+    for filename in files:
+        if not filename.endswith(THUMBNAIL_INDEX_EXTENSION):
+            continue
+        try:
+            index = CasysThumbnailIndex(filename)
+        except OSError:
+            continue
+        entry = index.closest(timestamp)
+        if entry is not None and (best is None or abs(entry[0] - timestamp) < abs(best[1][0] - timestamp)):
+            best = (index, entry)
+    if best is None:
+        raise NoThumbnailError(timestamp)
+    return best[0].read(best[1])
+
+
+class NoThumbnailError(CasysBaseError):
+    def __init__(self, Time=None):
+        self.__time = Time
+
+    def __str__(self):
+        if self.__time is None:
+            return "No thumbnail is available."
+        else:
+            return "No thumbnail is available near {}.".format(self.__time)
@@ -1,6 +1,14 @@
 NAME = 'Casys'
 VERSION = 1.0
 CONFIG_FILE = '@config'
+SETTINGS_FILE = 'casys.conf'
+CONFIG_POLL_TIME = 5
+
+CONTROL_SOCKET = './casys.sock'
+CONTROL_HTTP_ADDRESS = '127.0.0.1'
+CONTROL_HTTP_PORT = 0 # disabled
+CONTROL_WORKERS = 2
+CONTROL_EXPORT_PATH = './export'
 EPILOG = """Author: Michael Israel (Behman)
 E-mail: michael.behman@gmail.com
 """
@@ -23,6 +31,55 @@ LOG_MAIL_ENCODING = 'utf-32'
 
 VIDEO_DEV_FILES_PATTERN = '/dev/video*'
 VIDEO_STORAGE_PATH = './videos'
+VIDEO_STORAGE_PATHS = [VIDEO_STORAGE_PATH]
+VIDEO_MIN_FREE_SPACE = 512 * 1024 * 1024 # 512 MB
+STORAGE_REFRESH_TIME = 5
+STORAGE_RETRY_TIME = 60
+STORAGE_THROUGHPUT_WEIGHT = 0.3
+STORAGE_SEGMENT_RATE = 1024 * 1024 # 1 MB/s
 VIDEO_EXPIRE_DURATION = 24 * 60 * 60 #1 day
 EXTENSION = '.ogv'
 FRAGMENT_TIME = 60 * 60 #1 hour
+# Encoder element -> (bitrate property, multiplier from kbit/s)
+ENCODERS = {
+    'x264enc': ('bitrate', 1),
+    'vp8enc': ('target-bitrate', 1000),
+    'omxh264enc': ('target-bitrate', 1000),
+    'v4l2h264enc': (None, 0),
+    'jpegenc': (None, 0),
+}
+MUX_CLUSTER_DURATION = 1000000000 #1 second (in ns)
+RECOVERY_TAIL_SIZE = 256 * 1024 # 256 KB
+RECOVERY_MAX_SCAN = 16 * 1024 * 1024 # 16 MB, walking the headers of the clusters past it
+
+BENCH_LATENCY_INTERVAL = 100 # ms
+DISPLAY_MAX_LATENESS = 20 * 1000 * 1000 # ns, as the video sinks: later frames are dropped
+
+PROFILER_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024) # ms
+PROFILER_SLOW_KEEP = 100
+PROFILER_HEARTBEAT = 100 # ms
+PROFILER_THRESHOLD = 50 # ms
+PROFILER_TRACERS = 'latency(flags=pipeline+element);proctime;framerate'
+PROFILER_DUMP_FILE = 'casys-profile.json'
+
+MOTION_CAPS = 'video/x-raw,width=320,height=240'
+MOTION_POSTROLL = 10 # seconds of recording after the motion stops
+SCHEDULE_CHECK_TIME = 60
+
+THUMBNAIL_INTERVAL = 10 # seconds between thumbnails, 0 disables them
+THUMBNAIL_WIDTH = 160
+THUMBNAIL_QUALITY = 60
+THUMBNAIL_DATA_EXTENSION = '.thumbs'
+THUMBNAIL_INDEX_EXTENSION = '.tidx'
+
+SUPERVISOR_HEALTH_INTERVAL = 5
+SUPERVISOR_RESTART_DELAY = 2
+SUPERVISOR_MAX_RESTART_DELAY = 60
+
+REPLICATION_QUEUE = './casys-replication.db'
+REPLICATION_CONCURRENCY = 2
+REPLICATION_CHUNK_SIZE = 8 * 1024 * 1024 # 8 MB
+REPLICATION_POLL_TIME = 30
+REPLICATION_RETRY_TIME = 30
+REPLICATION_MAX_RETRY_TIME = 3600
+S3_MIN_PART_SIZE = 5 * 1024 * 1024 # 5 MB, except for the last part
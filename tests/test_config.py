@@ -0,0 +1,172 @@
+# Copyright 2020 Michael Israel
+#
+# This file is part of Casys.
+#
+# Casys is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Casys is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Casys.  If not, see <http://www.gnu.org/licenses/>.Copyright.
+"""
+Tests of the settings: the parsers of the values, the validation of the settings file and the
+changes reported on a reload.
+"""
+from casysConfig import CasysConfig, ConfigError, SCHEMA, parse_bool, parse_cpus, parse_days, parse_encoder, \
+    parse_framerate, parse_list, parse_minute, parse_positive, parse_size
+import os
+import tempfile
+import unittest
+from time import strptime
+
+SHIPPED_SETTINGS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'casys.conf')
+
+
+class ParsersTest(unittest.TestCase):
+    def test_list(self):
+        self.assertEqual(parse_list('./a, ./b\n./c,'), ['./a', './b', './c'])
+        self.assertEqual(parse_list(''), [])
+
+    def test_numbers(self):
+        self.assertEqual(parse_positive('3'), 3)
+        self.assertEqual(parse_size('0'), 0)
+        for parser, value in ((parse_positive, '0'), (parse_size, '-1'), (parse_size, 'x')):
+            with self.assertRaises(ValueError):
+                parser(value)
+
+    def test_bool(self):
+        self.assertTrue(parse_bool('Yes'))
+        self.assertFalse(parse_bool('off'))
+        with self.assertRaises(ValueError):
+            parse_bool('maybe')
+
+    def test_framerate(self):
+        self.assertEqual(parse_framerate('15'), '15/1')
+        self.assertEqual(parse_framerate('15/2'), '15/2')
+        with self.assertRaises(ValueError):
+            parse_framerate('15/0')
+
+    def test_cpus(self):
+        self.assertEqual(parse_cpus('0,2-3, 2'), (0, 2, 3))
+        self.assertEqual(parse_cpus(''), ())
+        with self.assertRaises(ValueError):
+            parse_cpus('3-1')
+
+    def test_encoder(self):
+        self.assertEqual(parse_encoder('none'), 'none')
+        with self.assertRaises(ValueError):
+            parse_encoder('mpeg1')
+
+    def test_days(self):
+        self.assertEqual(parse_days('weekdays'), frozenset(range(5)))
+        self.assertEqual(parse_days('sat-mon'), frozenset((5, 6, 0)))
+        with self.assertRaises(ValueError):
+            parse_days('someday')
+
+    def test_minute(self):
+        self.assertEqual(parse_minute('6'), 360)
+        self.assertEqual(parse_minute('22:30'), 1350)
+        self.assertEqual(parse_minute('24:00'), 1440)
+        with self.assertRaises(ValueError):
+            parse_minute('24:01')
+
+
+class ConfigTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self._directory.cleanup)
+        self.Filename = os.path.join(self._directory.name, 'casys.conf')
+
+    def _write(self, text):
+        with open(self.Filename, 'w') as settings_file:
+            settings_file.write(text)
+
+    def _config(self, text):
+        self._write(text)
+        return CasysConfig(self.Filename)
+
+    def test_missing_file_gives_the_defaults(self):
+        config = CasysConfig(self.Filename)
+        for section, options in SCHEMA.items():
+            for option, (_, default) in options.items():
+                self.assertEqual(config[section][option], default)
+
+    def test_shipped_settings(self):
+        config = CasysConfig(SHIPPED_SETTINGS)
+        self.assertEqual(config['control']['http_port'], 0)
+        self.assertFalse(config['replication']['enabled'])
+
+    def test_camera_overrides(self):
+        config = self._config('[camera]\nwidth = 640\nframerate = 10\n'
+                              '[camera:video1]\nwidth = 1280\n')
+        self.assertEqual(config.camera('video0')['width'], 640)
+        self.assertEqual(config.camera('video1')['width'], 1280)
+        self.assertEqual(config.camera('video1')['framerate'], '10/1')
+        self.assertEqual(config.named('camera'), ['video1'])
+
+    def test_invalid(self):
+        for text in ('[nothing]\n',
+                     '[storage:named]\n',
+                     '[storage]\nsize = 3\n',
+                     '[camera]\nwidth = wide\n',
+                     '[schedule]\nnight = night daily 22:00-06:00\n',
+                     'no section\n'):
+            self._write(text)
+            with self.assertRaises(ConfigError, msg=text):
+                CasysConfig(self.Filename)
+
+    def test_profiles(self):
+        config = self._config('[camera]\nframerate = 30\n'
+                              '[profile:night]\nframerate = 5\n'
+                              '[schedule]\nnight = night daily 22:00-06:00 video0\n')
+        night = strptime('2020-01-06 23:00', '%Y-%m-%d %H:%M')
+        day = strptime('2020-01-06 12:00', '%Y-%m-%d %H:%M')
+        self.assertEqual(config.camera('video0', night)['framerate'], '5/1')
+        self.assertEqual(config.camera('video0', day)['framerate'], '30/1')
+        self.assertEqual(config.camera('video1', night)['framerate'], '30/1')
+        # Options left out of a profile keep the camera settings.
+        self.assertEqual(config.camera('video0', night)['width'], 0)
+
+    def _reload(self, config, text):
+        changes = []
+        config.connect(lambda config, changed: changes.append(changed))
+        self._write(text)
+        config.reload()
+        return changes
+
+    def test_reload_changes(self):
+        config = self._config('[camera]\nwidth = 640\n[camera:video1]\nwidth = 1280\n[storage]\nfragment_time = 600\n')
+        changes = self._reload(config, '[camera]\nwidth = 640\n[camera:video1]\nwidth = 800\n'
+                                       '[storage]\nfragment_time = 600\n')
+        self.assertEqual(changes, [{'camera:video1'}])
+        self.assertEqual(config.camera('video1')['width'], 800)
+
+    def test_reload_defaults_change_all_cameras(self):
+        config = self._config('[camera]\nwidth = 640\n[camera:video1]\nheight = 480\n')
+        changes = self._reload(config, '[camera]\nwidth = 320\n[camera:video1]\nheight = 480\n')
+        self.assertEqual(changes, [{'camera', 'camera:video1'}])
+
+    def test_reload_schedule_changes_the_cameras(self):
+        config = self._config('[profile:night]\nframerate = 5\n')
+        changes = self._reload(config, '[profile:night]\nframerate = 5\n'
+                                       '[schedule]\nnight = night daily 22:00-06:00\n')
+        self.assertEqual(changes, [{'schedule', 'camera'}])
+
+    def test_reload_without_changes(self):
+        config = self._config('[camera]\nwidth = 640\n')
+        self.assertEqual(self._reload(config, '[camera]\nwidth = 640\n'), [])
+
+    def test_invalid_reload_keeps_the_settings(self):
+        config = self._config('[camera]\nwidth = 640\n')
+        self.assertEqual(self._reload(config, '[camera]\nwidth = -1\n'), [])
+        self.assertEqual(config['camera']['width'], 640)
+
+
+if __name__ == '__main__':
+    unittest.main()
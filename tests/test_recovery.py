@@ -0,0 +1,157 @@
+# Copyright 2020 Michael Israel
+#
+# This file is part of Casys.
+#
+# Casys is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Casys is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Casys.  If not, see <http://www.gnu.org/licenses/>.Copyright.
+"""
+Tests of the recovery of segments, on streamable matroska files as matroskamux writes them:
+a segment and clusters of unknown size.
+"""
+from casysRecovery import CasysSegmentRecovery, CasysSegmentFinalizer, CorruptSegmentError, read_vint, \
+    EBML_ID, SEGMENT_ID, CLUSTER_ID, CLUSTER_TIMESTAMP_ID
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+SIMPLE_BLOCK_ID = 0xA3
+INFO_ID = 0x1549A966
+UNKNOWN_SIZE = b'\x01\xff\xff\xff\xff\xff\xff\xff'
+
+
+def element(element_id, payload):
+    size = len(payload)
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big') + \
+        b'\x01' + size.to_bytes(7, 'big') + payload
+
+
+def cluster(timestamp, blocks):
+    """
+    A cluster of unknown size, and the offsets (from its start) of the ends of its children.
+    """
+    data = CLUSTER_ID.to_bytes(4, 'big') + UNKNOWN_SIZE
+    data += element(CLUSTER_TIMESTAMP_ID, bytes([timestamp]))
+    ends = [len(data)]
+    for block in blocks:
+        data += element(SIMPLE_BLOCK_ID, block)
+        ends.append(len(data))
+    return data, ends
+
+
+def streamable_segment(clusters):
+    """
+    A streamable matroska file and the offsets of its segment data and of its clusters.
+    """
+    header = element(EBML_ID, element(0x4282, b'matroska'))
+    data = header + SEGMENT_ID.to_bytes(4, 'big') + UNKNOWN_SIZE
+    data_start = len(data)
+    data += element(INFO_ID, element(0x2AD7B1, (1000000).to_bytes(3, 'big')))
+    starts = []
+    for cluster_data in clusters:
+        starts.append(len(data))
+        data += cluster_data
+    return data, data_start, starts
+
+
+class RecoveryTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self._directory.cleanup)
+        self.Filename = os.path.join(self._directory.name, 'video0 2020-01-01-00 0.mkv')
+        self.First, self.FirstEnds = cluster(0, [b'a' * 100, b'b' * 120])
+        self.Second, self.SecondEnds = cluster(1, [b'c' * 100, b'd' * 80, b'e' * 90])
+        self.Data, self.DataStart, self.Clusters = streamable_segment([self.First, self.Second])
+
+    def _write(self, size):
+        with open(self.Filename, 'wb') as segment:
+            segment.write(self.Data[:size])
+
+    def _read(self):
+        with open(self.Filename, 'rb') as segment:
+            return segment.read()
+
+    def _assert_sizes(self, data, cluster_start):
+        segment_size, size_length, unknown = read_vint(data, self.DataStart - 8)
+        self.assertFalse(unknown)
+        self.assertEqual(self.DataStart + segment_size, len(data))
+        cluster_size, size_length, unknown = read_vint(data, cluster_start + 4)
+        self.assertFalse(unknown)
+        self.assertEqual(cluster_start + 4 + size_length + cluster_size, len(data))
+
+    def test_cut_in_a_block(self):
+        second = self.Clusters[1]
+        self._write(second + self.SecondEnds[2] + 40)
+        self.assertTrue(CasysSegmentRecovery().recover(self.Filename))
+        data = self._read()
+        # The partial block is cut off, the two complete ones are kept.
+        self.assertEqual(len(data), second + self.SecondEnds[2])
+        self._assert_sizes(data, second)
+
+    def test_cut_in_a_cluster_header(self):
+        second = self.Clusters[1]
+        self._write(second + 7)
+        self.assertTrue(CasysSegmentRecovery().recover(self.Filename))
+        data = self._read()
+        # The segment ends with the first cluster, complete.
+        self.assertEqual(len(data), second)
+        self._assert_sizes(data, self.Clusters[0])
+
+    def test_cut_after_a_block(self):
+        second = self.Clusters[1]
+        self._write(len(self.Data))
+        self.assertTrue(CasysSegmentRecovery().recover(self.Filename))
+        data = self._read()
+        self.assertEqual(len(data), second + self.SecondEnds[-1])
+        self._assert_sizes(data, second)
+
+    def test_second_run_changes_nothing(self):
+        for size in (self.Clusters[1] + self.SecondEnds[1] + 3, self.Clusters[1] + 2):
+            self._write(size)
+            recovery = CasysSegmentRecovery()
+            self.assertTrue(recovery.recover(self.Filename))
+            repaired = self._read()
+            self.assertFalse(recovery.recover(self.Filename))
+            self.assertEqual(self._read(), repaired)
+
+    def test_clusters_larger_than_the_tail(self):
+        # Found by walking the headers, as for clusters of raw video larger than RECOVERY_MAX_SCAN.
+        second = self.Clusters[1]
+        self._write(second + self.SecondEnds[2] + 40)
+        with mock.patch('casysRecovery.RECOVERY_TAIL_SIZE', 16), mock.patch('casysRecovery.RECOVERY_MAX_SCAN', 64):
+            self.assertTrue(CasysSegmentRecovery().recover(self.Filename))
+        data = self._read()
+        self.assertEqual(len(data), second + self.SecondEnds[2])
+        self._assert_sizes(data, second)
+
+    def test_finalizer(self):
+        self._write(len(self.Data))
+        finalized = []
+        done = threading.Event()
+        finalizer = CasysSegmentFinalizer()
+        finalizer.finalize(self.Filename, lambda filename: (finalized.append(filename), done.set()))
+        self.assertTrue(done.wait(10))
+        finalizer.free()
+        self.assertEqual(finalized, [self.Filename])
+        self._assert_sizes(self._read(), self.Clusters[1])
+
+    def test_not_matroska(self):
+        with open(self.Filename, 'wb') as segment:
+            segment.write(b'\x00' * 64)
+        with self.assertRaises(CorruptSegmentError):
+            CasysSegmentRecovery().recover(self.Filename)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+# Copyright 2020 Michael Israel
+#
+# This file is part of Casys.
+#
+# Casys is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Casys is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Casys.  If not, see <http://www.gnu.org/licenses/>.Copyright.
+"""
+Tests of the replication queue, of the token bucket and of the local target.
+"""
+from casys_const import REPLICATION_RETRY_TIME, REPLICATION_MAX_RETRY_TIME
+from casysReplication import CasysReplicationQueue, CasysTokenBucket, CasysLocalTarget, ChecksumError, \
+    file_sha256
+import os
+import tempfile
+import unittest
+from time import time
+
+
+class ReplicationQueueTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self._directory.cleanup)
+        self.Filename = os.path.join(self._directory.name, 'queue.db')
+        self.Queue = CasysReplicationQueue(self.Filename)
+        self.addCleanup(lambda: self.Queue.free())
+
+    def test_due_in_queuing_order(self):
+        self.Queue.enqueue('a.mkv', 'b.mkv')
+        self.Queue.enqueue('c.mkv')
+        self.assertEqual([job['filename'] for job in self.Queue.due(10)], ['a.mkv', 'b.mkv', 'c.mkv'])
+        self.assertEqual([job['filename'] for job in self.Queue.due(1)], ['a.mkv'])
+        self.assertEqual([job['filename'] for job in self.Queue.due(2, exclude={'a.mkv'})], ['b.mkv', 'c.mkv'])
+
+    def test_progress_and_done(self):
+        self.Queue.enqueue('a.mkv')
+        self.Queue.restart('a.mkv', 300, 'f' * 64)
+        self.Queue.progress('a.mkv', 100, '{"parts": 1}')
+        job = self.Queue.get('a.mkv')
+        self.assertEqual((job['size'], job['offset'], job['target_state']), (300, 100, '{"parts": 1}'))
+        self.assertFalse(self.Queue.is_replicated('a.mkv'))
+
+        self.Queue.done('a.mkv')
+        self.assertTrue(self.Queue.is_replicated('a.mkv'))
+        self.assertEqual(self.Queue.due(10), [])
+        # Queuing a replicated segment again keeps it replicated.
+        self.Queue.enqueue('a.mkv')
+        self.assertTrue(self.Queue.is_replicated('a.mkv'))
+
+    def test_restart(self):
+        self.Queue.enqueue('a.mkv')
+        self.Queue.restart('a.mkv', 300, 'f' * 64)
+        self.Queue.progress('a.mkv', 100, '{}')
+        self.Queue.restart('a.mkv', 400, 'e' * 64)
+        job = self.Queue.get('a.mkv')
+        self.assertEqual((job['size'], job['sha256'], job['offset'], job['target_state']),
+                         (400, 'e' * 64, 0, None))
+
+    def test_retry_backs_off(self):
+        self.Queue.enqueue('a.mkv')
+        delays = [self.Queue.retry('a.mkv', 'failed') for _ in range(10)]
+        self.assertEqual(delays[:3], [REPLICATION_RETRY_TIME, 2 * REPLICATION_RETRY_TIME, 4 * REPLICATION_RETRY_TIME])
+        self.assertEqual(delays[-1], REPLICATION_MAX_RETRY_TIME)
+        self.assertEqual(self.Queue.due(10), [])
+        job = self.Queue.get('a.mkv')
+        self.assertEqual((job['attempts'], job['error']), (10, 'failed'))
+        self.assertGreater(job['next_try'], time())
+        self.assertEqual([failing['filename'] for failing in self.Queue.metrics()['failing']], ['a.mkv'])
+        self.assertIsNone(self.Queue.retry('b.mkv', 'failed'))
+
+    def test_forget(self):
+        self.Queue.enqueue('a.mkv')
+        self.Queue.done('a.mkv')
+        self.Queue.forget('a.mkv')
+        self.assertIsNone(self.Queue.get('a.mkv'))
+        self.assertFalse(self.Queue.is_replicated('a.mkv'))
+
+    def test_metrics(self):
+        self.Queue.enqueue('a.mkv', 'b.mkv')
+        self.Queue.restart('a.mkv', 300, 'f' * 64)
+        self.Queue.done('a.mkv')
+        metrics = self.Queue.metrics()
+        self.assertEqual(metrics['done'], {'segments': 1, 'bytes': 300})
+        self.assertEqual(metrics['pending'], {'segments': 1, 'bytes': 0})
+
+    def test_persistent(self):
+        self.Queue.enqueue('a.mkv', 'b.mkv')
+        self.Queue.done('a.mkv')
+        self.Queue.progress('b.mkv', 100, '{}')
+        self.Queue.free()
+        self.Queue = CasysReplicationQueue(self.Filename)
+        self.assertTrue(self.Queue.is_replicated('a.mkv'))
+        self.assertEqual([(job['filename'], job['offset']) for job in self.Queue.due(10)], [('b.mkv', 100)])
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_chunk_size(self):
+        bucket = CasysTokenBucket(1000000)
+        self.assertEqual(bucket.chunk_size(8000000, 1), 1000000)
+        self.assertEqual(bucket.chunk_size(8000000, 1, shares=4), 250000)
+        self.assertEqual(bucket.chunk_size(100, 1), 100)
+        # Never below the minimum of the target (e.g. the parts of S3).
+        self.assertEqual(bucket.chunk_size(8000000, 5000000), 5000000)
+
+    def test_unlimited(self):
+        self.assertEqual(CasysTokenBucket(0).chunk_size(8000000, 1), 8000000)
+
+
+class LocalTargetTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self._directory.cleanup)
+        self.Target = CasysLocalTarget(os.path.join(self._directory.name, 'target'))
+        self.Source = os.path.join(self._directory.name, 'a.mkv')
+        self.Data = os.urandom(1000)
+        with open(self.Source, 'wb') as source:
+            source.write(self.Data)
+        self.Sha256 = file_sha256(self.Source)
+
+    def test_resume(self):
+        self.assertEqual(self.Target.resume('a.mkv', 1000, self.Sha256, 0, None), (0, None))
+        self.Target.write('a.mkv', None, 0, self.Data[:400])
+        self.Target.write('a.mkv', None, 400, self.Data[400:700])
+        # Only the first chunk was saved as written: the second is written again.
+        self.assertEqual(self.Target.resume('a.mkv', 1000, self.Sha256, 400, None), (400, None))
+        self.Target.write('a.mkv', None, 400, self.Data[400:])
+        self.Target.finish('a.mkv', None, 1000, self.Sha256)
+        with open(os.path.join(self.Target.Path, 'a.mkv'), 'rb') as replica:
+            self.assertEqual(replica.read(), self.Data)
+
+    def test_checksum(self):
+        self.Target.write('a.mkv', None, 0, self.Data[:999] + bytes([self.Data[999] ^ 1]))
+        with self.assertRaises(ChecksumError):
+            self.Target.finish('a.mkv', None, 1000, self.Sha256)
+        self.assertFalse(os.path.exists(os.path.join(self.Target.Path, 'a.mkv')))
+
+
+if __name__ == '__main__':
+    unittest.main()
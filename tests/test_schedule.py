@@ -0,0 +1,88 @@
+# Copyright 2020 Michael Israel
+#
+# This file is part of Casys.
+#
+# Casys is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Casys is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Casys.  If not, see <http://www.gnu.org/licenses/>.Copyright.
+"""
+Tests of the schedule rules.
+"""
+from casysConfig import parse_rule, rule_matches
+from time import strptime
+import unittest
+
+
+def at(value):
+    """
+    A time given as 'YYYY-mm-dd HH:MM'. 2020-01-06 is a Monday.
+    """
+    return strptime(value, '%Y-%m-%d %H:%M')
+
+
+class ParseRuleTest(unittest.TestCase):
+    def test_rule(self):
+        self.assertEqual(parse_rule('night weekdays 22:00-06:30 video0,video1'),
+                         ('night', frozenset(range(5)), 22 * 60, 6 * 60 + 30, ('video0', 'video1')))
+
+    def test_days(self):
+        self.assertEqual(parse_rule('a mon-wed,sat 8-9')[1], frozenset((0, 1, 2, 5)))
+        # A range of days going over the end of the week.
+        self.assertEqual(parse_rule('a fri-mon 8-9')[1], frozenset((4, 5, 6, 0)))
+        self.assertEqual(parse_rule('a Weekends 8-9')[1], frozenset((5, 6)))
+
+    def test_invalid(self):
+        for value in ('night', 'night daily', 'night daily 25:00-06:00', 'night someday 22:00-06:00',
+                      'night daily 22:00-06:00 video0 extra'):
+            with self.assertRaises(ValueError):
+                parse_rule(value)
+
+
+class RuleMatchesTest(unittest.TestCase):
+    def test_same_day(self):
+        rule = parse_rule('day weekdays 08:00-18:00')
+        self.assertTrue(rule_matches(rule, 'video0', at('2020-01-06 08:00')))
+        self.assertTrue(rule_matches(rule, 'video0', at('2020-01-06 17:59')))
+        self.assertFalse(rule_matches(rule, 'video0', at('2020-01-06 18:00')))
+        self.assertFalse(rule_matches(rule, 'video0', at('2020-01-11 12:00')))
+
+    def test_over_midnight(self):
+        # From Friday 22:00 to Saturday 06:00, and from Saturday 22:00 to Sunday 06:00.
+        rule = parse_rule('night fri-sat 22:00-06:00')
+        self.assertFalse(rule_matches(rule, 'video0', at('2020-01-10 06:00')))
+        self.assertFalse(rule_matches(rule, 'video0', at('2020-01-10 21:59')))
+        self.assertTrue(rule_matches(rule, 'video0', at('2020-01-10 22:00')))
+        self.assertTrue(rule_matches(rule, 'video0', at('2020-01-11 00:00')))
+        self.assertTrue(rule_matches(rule, 'video0', at('2020-01-11 05:59')))
+        self.assertFalse(rule_matches(rule, 'video0', at('2020-01-11 06:00')))
+        self.assertTrue(rule_matches(rule, 'video0', at('2020-01-11 23:00')))
+        self.assertTrue(rule_matches(rule, 'video0', at('2020-01-12 05:00')))
+        # Sunday evening starts no night, so Monday morning is not in it.
+        self.assertFalse(rule_matches(rule, 'video0', at('2020-01-12 23:00')))
+        self.assertFalse(rule_matches(rule, 'video0', at('2020-01-13 05:00')))
+
+    def test_over_midnight_end_of_week(self):
+        # Sunday night goes on into Monday morning.
+        rule = parse_rule('night sun 23:00-01:00')
+        self.assertTrue(rule_matches(rule, 'video0', at('2020-01-12 23:30')))
+        self.assertTrue(rule_matches(rule, 'video0', at('2020-01-13 00:30')))
+        self.assertFalse(rule_matches(rule, 'video0', at('2020-01-13 01:00')))
+        self.assertFalse(rule_matches(rule, 'video0', at('2020-01-14 00:30')))
+
+    def test_cameras(self):
+        rule = parse_rule('night daily 22:00-06:00 video1')
+        self.assertTrue(rule_matches(rule, 'video1', at('2020-01-06 23:00')))
+        self.assertFalse(rule_matches(rule, 'video0', at('2020-01-06 23:00')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+# Copyright 2020 Michael Israel
+#
+# This file is part of Casys.
+#
+# Casys is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Casys is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Casys.  If not, see <http://www.gnu.org/licenses/>.Copyright.
+"""
+Tests of the timeline thumbnails, including the files left by a crash.
+"""
+from casysThumbnails import CasysThumbnailWriter, CasysThumbnailIndex, NoThumbnailError, RECORD, \
+    thumbnail_files, timeline, read_thumbnail
+import os
+import tempfile
+import unittest
+
+
+class ThumbnailIndexTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self._directory.cleanup)
+        self.Segment = os.path.join(self._directory.name, 'video0 2020-01-01-00 0.mkv')
+        self.DataFile, self.IndexFile = thumbnail_files(self.Segment)
+        writer = CasysThumbnailWriter()
+        writer.open(self.Segment)
+        for second in range(5):
+            writer.append(1000.0 + 10 * second, bytes([second]) * (100 + second))
+        writer.free()
+
+    def test_entries(self):
+        index = CasysThumbnailIndex(self.IndexFile)
+        self.assertEqual(len(index.Entries), 5)
+        self.assertEqual((index.Start, index.End), (1000.0, 1040.0))
+        self.assertEqual(index.read(index.Entries[2]), b'\x02' * 102)
+
+    def test_torn_index_record(self):
+        # A crash in the middle of writing an index record.
+        with open(self.IndexFile, 'ab') as index_file:
+            index_file.write(RECORD.pack(1050.0, 1000, 10)[:RECORD.size // 2])
+        index = CasysThumbnailIndex(self.IndexFile)
+        self.assertEqual(len(index.Entries), 5)
+        self.assertEqual(index.End, 1040.0)
+
+    def test_record_past_the_data(self):
+        # The index record was written, but the end of the thumbnail did not reach the disk.
+        os.truncate(self.DataFile, os.path.getsize(self.DataFile) - 1)
+        index = CasysThumbnailIndex(self.IndexFile)
+        self.assertEqual(len(index.Entries), 4)
+        self.assertEqual(index.End, 1030.0)
+
+    def test_between(self):
+        index = CasysThumbnailIndex(self.IndexFile)
+        self.assertEqual([entry[0] for entry in index.between(1005, 1030)], [1010.0, 1020.0, 1030.0])
+        self.assertEqual(index.between(2000, 3000), [])
+
+    def test_closest(self):
+        index = CasysThumbnailIndex(self.IndexFile)
+        self.assertEqual(index.closest(1014)[0], 1010.0)
+        self.assertEqual(index.closest(1016)[0], 1020.0)
+        self.assertEqual(index.closest(0)[0], 1000.0)
+        self.assertEqual(index.closest(5000)[0], 1040.0)
+
+    def test_empty_index(self):
+        open(self.IndexFile, 'wb').close()
+        index = CasysThumbnailIndex(self.IndexFile)
+        self.assertIsNone(index.Start)
+        self.assertIsNone(index.closest(1000))
+
+    def test_timeline(self):
+        files = [self.Segment, self.DataFile, self.IndexFile]
+        os.utime(self.IndexFile, (1040, 1040))
+        thumbnails = timeline(files, 1000, 1040, step=15)
+        self.assertEqual([thumbnail['time'] for thumbnail in thumbnails], [1000.0, 1020.0, 1040.0])
+        self.assertEqual(thumbnails[1]['file'], self.DataFile)
+        self.assertEqual(read_thumbnail(files, 1021), b'\x02' * 102)
+
+    def test_no_thumbnail(self):
+        with self.assertRaises(NoThumbnailError):
+            read_thumbnail([self.Segment], 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()